@@ -83,12 +83,10 @@ do
       --num ${NSAMPLES_PER_RUN} --trivial-parallel --print-every 8 \
       --metadata-file ${METADATA_FILE}"
     echo "args" $args
+    # Write each cell's metadata yaml (if not there yet), then simulate, all in one launch
     srun --input none -k -n $((${SLURM_NNODES}*${THREADS_PER_NODE})) \
 	 --ntasks-per-node ${THREADS_PER_NODE} \
-	 $PYTHON run.py $args
-
-    # Write one metadata yaml per cell
-    srun -n ${NCELLS} $PYTHON $args --metadata-only
+	 $PYTHON run.py $args --pipeline
     
     chmod -R a+r $RUNDIR/*.yaml
     # run.py sets permissions on the data files themselves (doing them here simultaneously takes forever)
@@ -0,0 +1,68 @@
+"""
+Check how long it takes to start up run.py
+
+Every rank of a production run pays for importing run.py (and with it
+models.py, NEURON and the mechanisms) before doing any work, so keep it
+headless and lazy. This times the import in fresh interpreters, lists the
+slowest modules, and exits nonzero if the median is over budget:
+
+$ python bench_import.py --budget 2.0
+"""
+from __future__ import print_function
+
+import sys
+import subprocess
+import logging as log
+from datetime import datetime
+from argparse import ArgumentParser
+
+
+def time_import(module):
+    _start = datetime.now()
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)])
+    return (datetime.now() - _start).total_seconds()
+
+
+def slowest_imports(module, n=10):
+    """
+    The n modules with the largest cumulative import time (python -X importtime), in seconds
+    """
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = proc.communicate()
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(times, reverse=True)[:n]
+
+
+def main(args):
+    times = sorted(time_import(args.module) for _ in range(args.repeat))
+    median = times[len(times) // 2]
+
+    print("import {}: median {:.2f} s, min {:.2f} s, max {:.2f} s over {} runs".format(
+        args.module, median, times[0], times[-1], args.repeat))
+    print("Slowest imports (cumulative):")
+    for seconds, name in slowest_imports(args.module, args.top):
+        print("  {:6.3f} s  {}".format(seconds, name))
+
+    if median > args.budget:
+        log.error("Over budget: {:.2f} s > {:.2f} s".format(median, args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--module', type=str, default='run')
+    parser.add_argument('--budget', type=float, default=2.0, help='max median import time (s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest modules to list')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
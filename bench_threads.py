@@ -0,0 +1,106 @@
+"""
+Benchmark ranks x threads per node for run.py
+
+Runs run.py once for each combination of MPI ranks and NEURON threads per
+rank (--nthread) that fits on the node, and reports the throughput and the
+peak memory of the largest rank. Everything after -- is passed to run.py, eg:
+
+$ python bench_threads.py --cores 64 --ranks 64 32 16 --threads 1 2 4 -- \
+    --model BBP --m-type L5_TTPC1 --e-type cADpyr --stim-file stims/chaotic_1.csv
+"""
+from __future__ import print_function
+
+import os
+import sys
+import shlex
+import shutil
+import resource
+import tempfile
+import subprocess
+import logging as log
+from datetime import datetime
+from argparse import ArgumentParser
+
+
+def _run_cmd(cmd):
+    # Run in a fresh process, so RUSAGE_CHILDREN only covers this run
+    _start = datetime.now()
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+    elapsed = (datetime.now() - _start).total_seconds()
+    maxrss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0 # largest single rank
+    return returncode, elapsed, maxrss_mb
+
+
+def run_one(args, run_args, ranks, threads, outdir):
+    import multiprocessing
+
+    outfile = os.path.join(outdir, 'bench_{}x{}.h5'.format(ranks, threads))
+    cmd = shlex.split(args.launcher.format(ranks=ranks, threads=threads)) + \
+          [sys.executable, 'run.py'] + run_args + \
+          ['--num', str(ranks * args.num), '--nthread', str(threads), '--outfile', outfile]
+    if args.multisplit:
+        cmd.append('--multisplit')
+    log.debug(' '.join(cmd))
+
+    pool = multiprocessing.Pool(1)
+    result = pool.apply(_run_cmd, (cmd,))
+    pool.close()
+    pool.join()
+    return result
+
+
+def main(args, run_args):
+    outdir = tempfile.mkdtemp(prefix='bench_threads_')
+    configs = [(ranks, threads) for ranks in args.ranks for threads in args.threads
+               if ranks * threads <= args.cores]
+
+    print("ranks  threads  samples/s  sec/sample/rank  max rank RSS (MB)")
+    results = []
+    try:
+        for ranks, threads in configs:
+            returncode, elapsed, maxrss_mb = run_one(args, run_args, ranks, threads, outdir)
+            if returncode != 0:
+                print("{:5d}  {:7d}  failed (exit code {})".format(ranks, threads, returncode))
+                continue
+            throughput = ranks * args.num / elapsed
+            results.append((ranks, threads, throughput, elapsed / args.num, maxrss_mb))
+            print("{:5d}  {:7d}  {:9.2f}  {:15.2f}  {:17.0f}".format(*results[-1]))
+    finally:
+        shutil.rmtree(outdir)
+
+    if args.csv:
+        with open(args.csv, 'w') as outfile:
+            print("ranks,threads,samples_per_sec,sec_per_sample_per_rank,max_rss_mb", file=outfile)
+            for row in results:
+                print(','.join(str(x) for x in row), file=outfile)
+
+    if results:
+        ranks, threads = max(results, key=lambda row: row[2])[:2]
+        print("Best: {} ranks x {} threads".format(ranks, threads))
+
+
+if __name__ == '__main__':
+    if '--' in sys.argv:
+        split = sys.argv.index('--')
+        argv, run_args = sys.argv[1:split], sys.argv[split+1:]
+    else:
+        argv, run_args = sys.argv[1:], []
+
+    parser = ArgumentParser()
+    parser.add_argument('--cores', type=int, required=True, help='cores per node')
+    parser.add_argument('--ranks', type=int, nargs='+', required=True, help='ranks per node to try')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4], help='threads per rank to try')
+    parser.add_argument('--num', type=int, default=4, help='samples per rank in each run')
+    parser.add_argument('--multisplit', action='store_true', default=False,
+                        help='pass --multisplit to run.py (otherwise threads only help with several cells per rank)')
+    parser.add_argument('--launcher', type=str, default='mpirun -n {ranks}',
+                        help="command to launch run.py with, eg 'srun -n {ranks} -c {threads}'")
+    parser.add_argument('--csv', type=str, default=None, help='also write the results to this csv')
+    parser.add_argument('--debug', action='store_true', default=False)
+
+    args = parser.parse_args(argv)
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.DEBUG if args.debug else log.INFO)
+
+    main(args, run_args)
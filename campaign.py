@@ -0,0 +1,190 @@
+"""
+Work out what is left to do in a production campaign from its output files
+
+Scans the output tree for h5 files written by run.py, counts the samples
+(and the samples that pass QA) already written for each (cell, stimulus),
+and writes a manifest of the work units needed to reach the target. Files
+from interrupted runs are counted up to the last written sample, so
+partially done cells are topped up rather than redone. run.py runs the
+manifest directly:
+
+$ python campaign.py --root runs --cells-csv allcells.csv --start 121 --end 169 \
+    --stims chaotic_2 --target 40 --unit-size 20 --out manifest.json
+$ srun -n 96 python run.py --model BBP --trivial-parallel --manifest manifest.json
+"""
+from __future__ import print_function
+
+import os
+import json
+import logging as log
+from datetime import datetime
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+
+import readers
+from scheduler import read_cells_csv, find_cell_i
+
+
+def _names_from_filename(path):
+    # run.py output files are named <bbp_name>-<stimname>-...h5 (see BBP_sbatch.sh)
+    parts = os.path.basename(path)[:-len('.h5')].split('-')
+    return parts[0], parts[1] if len(parts) > 1 else None
+
+
+def _str(x):
+    return x.decode() if isinstance(x, bytes) else x
+
+
+def scan_file(path):
+    """
+    Return {path, bbp_name, stim, complete, samples, passed} for one output
+    file, or None if it cannot be read (eg it is still being written)
+    """
+    try:
+        f = readers.open_file(path)
+    except (IOError, OSError) as e:
+        log.warning("Skipping {}: {}".format(path, e))
+        return None
+
+    with f:
+        bbp_name, stim = _names_from_filename(path)
+        bbp_name = f.attrs.get('bbpName', bbp_name)
+        stim = f.attrs.get('stimName', stim)
+        complete = readers.is_complete(f)
+        qa = f['binQA'][:]
+        if complete:
+            written = np.ones(len(qa), dtype=bool)
+        elif 'nValid' in f:
+            written = np.arange(len(qa)) < readers.n_valid(f)
+        elif 'norm_par' in f:
+            # Rows that were never written are all zero
+            written = np.any(f['norm_par'][:] != 0, axis=1)
+        else:
+            written = np.zeros(len(qa), dtype=bool)
+
+    return {
+        'path': path,
+        'bbp_name': _str(bbp_name),
+        'stim': _str(stim),
+        'complete': complete,
+        'samples': int(np.sum(written)),
+        'passed': int(np.sum(qa[written] > 0)),
+    }
+
+
+def scan_outputs(root):
+    records = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fn in sorted(filenames):
+            if fn.endswith('.h5'):
+                record = scan_file(os.path.join(dirpath, fn))
+                if record is not None:
+                    records.append(record)
+    return records
+
+
+def tally(records):
+    """
+    {(bbp_name, stim): {'samples': n, 'passed': n, 'files': n}} summed over files
+    """
+    totals = defaultdict(lambda: {'samples': 0, 'passed': 0, 'files': 0})
+    for record in records:
+        total = totals[(record['bbp_name'], record['stim'])]
+        total['samples'] += record['samples']
+        total['passed'] += record['passed']
+        total['files'] += 1
+    return totals
+
+
+def _new_outfile(root, bbp_name, stim, taken):
+    i = 0
+    while True:
+        path = os.path.join(root, bbp_name, '{}-{}-topup{}.h5'.format(bbp_name, stim, i))
+        if path not in taken and not os.path.exists(path):
+            taken.add(path)
+            return path
+        i += 1
+
+
+def plan(rows, stims, totals, target, count, unit_size, root, stim_dir='stims'):
+    """
+    Return the work units needed to bring every (cell, stimulus) up to
+    target samples (count='samples') or passing samples (count='passed')
+    """
+    with open('cells.json') as infile:
+        cells = json.load(infile)
+
+    units = []
+    taken = set()
+    for bbp_name, m_type, e_type in rows:
+        cell_i = find_cell_i(cells, m_type, e_type, bbp_name)
+        for stim in stims:
+            have = totals.get((bbp_name, stim), {}).get(count, 0)
+            remaining = target - have
+            while remaining > 0:
+                n = min(unit_size, remaining)
+                unit = {
+                    'bbp_name': bbp_name,
+                    'm_type': m_type,
+                    'e_type': e_type,
+                    'cell_i': cell_i,
+                    'stim_file': os.path.join(stim_dir, stim + '.csv'),
+                    'outfile': _new_outfile(root, bbp_name, stim, taken),
+                }
+                unit['target_pass' if count == 'passed' else 'num'] = n
+                units.append(unit)
+                remaining -= n
+    return units
+
+
+def main(args):
+    rows = read_cells_csv(args.cells_csv, args.start, args.end)
+    totals = tally(scan_outputs(args.root))
+    count = 'passed' if args.count_passed else 'samples'
+
+    n_done = n_partial = 0
+    for bbp_name, _, _ in rows:
+        for stim in args.stims:
+            have = totals.get((bbp_name, stim), {}).get(count, 0)
+            if have >= args.target:
+                n_done += 1
+            elif have > 0:
+                n_partial += 1
+    log.info("{} of {} (cell, stimulus) pairs done, {} partially done".format(
+        n_done, len(rows) * len(args.stims), n_partial))
+
+    units = plan(rows, args.stims, totals, args.target, count, args.unit_size, args.root,
+                 stim_dir=args.stim_dir)
+    manifest = {
+        'created': datetime.now().isoformat(),
+        'root': args.root,
+        'target': args.target,
+        'count': count,
+        'units': units,
+    }
+    with open(args.out, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+    log.info("Wrote {} work units to {}".format(len(units), args.out))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='output tree to scan, and to write new files into')
+    parser.add_argument('--cells-csv', type=str, default='allcells.csv')
+    parser.add_argument('--start', type=int, default=None, help='first row of --cells-csv in the campaign')
+    parser.add_argument('--end', type=int, default=None, help='one past the last row of --cells-csv')
+    parser.add_argument('--stims', type=str, nargs='+', required=True, help='stimulus names (files in --stim-dir)')
+    parser.add_argument('--stim-dir', type=str, default='stims')
+    parser.add_argument('--target', type=int, required=True, help='samples wanted per (cell, stimulus)')
+    parser.add_argument('--count-passed', action='store_true', default=False,
+                        help='count only samples that pass QA towards --target (work units use --target-pass)')
+    parser.add_argument('--unit-size', type=int, default=20, help='max samples per work unit (one rank, one file)')
+    parser.add_argument('--out', type=str, default='manifest.json')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
@@ -0,0 +1,323 @@
+"""
+Precomputed metadata for every BBP cell in cells.json
+
+Setup code in run.py (get_random_params, create_h5, _normalize, get_stim,
+...) only needs a BBP model's parameter ranges, defaults, varied params and
+probe names, but getting them from a models.BBP means building the whole
+cell. Build the catalog once with:
+
+$ python cell_catalog.py --out cell_catalog.json
+
+and run.py will answer those queries from the file instead (see --catalog).
+Cells are built in parallel (--procs N, or --mpi under srun), and progress
+is saved as each cell finishes so an interrupted build can be rerun.
+"""
+from __future__ import print_function
+
+import os
+import json
+import logging as log
+from argparse import ArgumentParser
+
+CATALOG_FILE = 'cell_catalog.json'
+
+_catalogs = {}
+
+
+def load_catalog(filename=CATALOG_FILE):
+    """
+    Return the catalog as a dict keyed by model_directory (bbp name), or
+    an empty dict if the file does not exist. Cached per process.
+    """
+    if filename not in _catalogs:
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                _catalogs[filename] = json.load(infile)
+        else:
+            _catalogs[filename] = {}
+    return _catalogs[filename]
+
+
+def catalog_entry(model):
+    """
+    Extract everything the catalog stores from a BBP model whose cell has been created
+    """
+    return {
+        'm_type': model.m_type,
+        'e_type': model.e_type,
+        'cell_i': model.cell_i,
+        'model_directory': model.cell_kwargs['model_directory'],
+        'param_names': list(model.PARAM_NAMES),
+        'param_ranges': [list(_range) for _range in model.PARAM_RANGES],
+        'default_params': list(model.DEFAULT_PARAMS),
+        'varied_params': [bool(x) for x in model.get_varied_params()],
+        'probe_names': model.get_all_probe_names(),
+        'probe_distances': model.get_all_probe_distances(),
+        'rec_pt_sections': [sec.hname() for sec in model._get_all_rec_pts()],
+        'nsec': sum(1 for sec in model.entire_cell.all),
+        'nseg': sum(sec.nseg for sec in model.entire_cell.all),
+    }
+
+
+class CatalogModel(object):
+    """
+    Stand-in for a BBP model that answers metadata queries from its catalog
+    entry, without instantiating the cell. Cannot simulate.
+    """
+    def __init__(self, entry, model_cls, cell_kwargs, probes=None):
+        self.entry = entry
+        self.m_type = entry['m_type']
+        self.e_type = entry['e_type']
+        self.cell_i = entry['cell_i']
+        self.cell_kwargs = cell_kwargs
+        self.probe_spec = probes
+
+        self.PARAM_NAMES = model_cls.PARAM_NAMES
+        self.STIM_MULTIPLIER = model_cls.STIM_MULTIPLIER
+        self.PARAM_RANGES = tuple(tuple(_range) for _range in entry['param_ranges'])
+        self.DEFAULT_PARAMS = tuple(entry['default_params'])
+
+    def get_varied_params(self):
+        return list(self.entry['varied_params'])
+
+    def get_all_probe_names(self):
+        return list(self.entry['probe_names'])
+
+    def get_all_probe_distances(self):
+        return self.entry.get('probe_distances') # None in catalogs built before it was added
+
+    def get_probe_names(self):
+        from models import select_probes
+        all_names = self.get_all_probe_names()
+        return [all_names[i] for i in select_probes(all_names, self.probe_spec, self.get_all_probe_distances())]
+
+    def _n_rec_pts(self):
+        return len(self.get_probe_names())
+
+
+def lookup(m_type, e_type, cell_i=0, probes=None, filename=CATALOG_FILE):
+    """
+    Return a CatalogModel for the given cell, or None if it is not in the catalog
+    """
+    import models
+
+    with open('cells.json') as infile:
+        cell_kwargs = json.load(infile)[m_type][e_type][cell_i]
+
+    entry = load_catalog(filename).get(cell_kwargs['model_directory'])
+    if entry is None or (probes and 'probe_distances' not in entry):
+        return None # not cataloged, or by an older version that cannot select probes by distance
+    return CatalogModel(entry, models.bbp_class(e_type), cell_kwargs, probes=probes)
+
+
+def iter_cells(cells):
+    """
+    Yield (m_type, e_type, cell_i) for every cell in cells.json
+    """
+    for m_type in sorted(cells):
+        for e_type in sorted(cells[m_type]):
+            for cell_i in range(len(cells[m_type][e_type])):
+                yield m_type, e_type, cell_i
+
+
+def build_entry(m_type, e_type, cell_i):
+    import models
+
+    model = models.bbp_class(e_type)(m_type, e_type, cell_i, log=log)
+    model.create_cell()
+    return catalog_entry(model)
+
+
+def build_morphology(m_type, e_type, cell_i):
+    """
+    Fast path: load only the morphology through import3d, without the
+    template or biophysics (so no compiled mechanisms are needed). nseg is
+    computed with the same rule as the templates' geom_nseg()
+    """
+    from neuron import h
+
+    with open('cells.json') as infile:
+        cell_kwargs = json.load(infile)[m_type][e_type][cell_i]
+    morph_file = os.path.join('hoc_templates', cell_kwargs['model_directory'], 'morphology',
+                              cell_kwargs['morphology'])
+
+    h.load_file('import3d.hoc')
+    reader = h.Import3d_Neurolucida3()
+    reader.quiet = 1
+    reader.input(morph_file)
+    importer = h.Import3d_GUI(reader, 0)
+    importer.instantiate(None)
+
+    secs = list(h.allsec())
+    return {
+        'm_type': m_type,
+        'e_type': e_type,
+        'cell_i': cell_i,
+        'model_directory': cell_kwargs['model_directory'],
+        'nsec': len(secs),
+        'nseg': sum(1 + 2*int(sec.L/40) for sec in secs),
+    }
+
+
+def build_one(task):
+    """
+    Instantiate one cell and report how it went. Run in a fresh process
+    per cell (see build_all()) so hoc templates and memory usage do not
+    carry over between cells
+    """
+    import resource
+    import time
+    import traceback
+
+    m_type, e_type, cell_i, morphology_only = task
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _start = time.time()
+    record = {'m_type': m_type, 'e_type': e_type, 'cell_i': cell_i, 'morphology_only': morphology_only}
+    try:
+        build = build_morphology if morphology_only else build_entry
+        record['entry'] = build(m_type, e_type, cell_i)
+        record['ok'] = True
+        record['error'] = None
+    except Exception:
+        record['entry'] = None
+        record['ok'] = False
+        record['error'] = traceback.format_exc()
+    record['seconds'] = time.time() - _start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kB on Linux
+    record['maxrss_mb'] = rss_after / 1024.0
+    record['rss_delta_mb'] = (rss_after - rss_before) / 1024.0
+    if record['ok']:
+        record['nseg'] = record['entry']['nseg']
+    return record
+
+
+def _progress_file(out, rank=0):
+    return '{}.progress.{}.jsonl'.format(out, rank)
+
+
+def load_progress(out):
+    """
+    All records from previous (possibly interrupted) builds, keyed by
+    (m_type, e_type, cell_i, morphology_only). Later records win
+    """
+    import glob
+
+    records = {}
+    for fn in sorted(glob.glob('{}.progress.*.jsonl'.format(out))):
+        with open(fn) as infile:
+            for line in infile:
+                record = json.loads(line)
+                key = (record['m_type'], record['e_type'], record['cell_i'], record['morphology_only'])
+                records[key] = record
+    return records
+
+
+def build_all(tasks, out, procs=1, comm=None, retry_failed=False):
+    """
+    Run build_one() for each (m_type, e_type, cell_i, morphology_only) task
+    that has not already been done, either in a process pool or strided
+    over MPI ranks. Either way each cell is built in a fresh process, so
+    its maxrss is its own. Each record is appended to a progress file as
+    soon as it is done, so an interrupted build can be resumed.
+
+    Return all records (including ones from previous builds) on the root
+    process, None on other ranks
+    """
+    rank = comm.Get_rank() if comm else 0
+    done = load_progress(out)
+    todo = [task for task in tasks
+            if task not in done or (retry_failed and not done[task]['ok'])]
+    log.info("{} of {} cells already done".format(len(tasks) - len(todo), len(tasks)))
+
+    import multiprocessing
+
+    with open(_progress_file(out, rank), 'a') as progress:
+        if comm:
+            # One worker per rank, replaced after every cell
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            results = pool.imap(build_one, todo[rank::comm.Get_size()])
+        else:
+            pool = multiprocessing.Pool(procs, maxtasksperchild=1)
+            results = pool.imap_unordered(build_one, todo)
+
+        for record in results:
+            status = 'ok' if record['ok'] else 'FAILED'
+            log.info("{} {} {}: {} in {:.1f} s, {:.0f} MB".format(
+                record['m_type'], record['e_type'], record['cell_i'], status,
+                record['seconds'], record['maxrss_mb']))
+            print(json.dumps(record), file=progress)
+            progress.flush()
+
+        pool.close()
+        pool.join()
+
+    if comm:
+        comm.Barrier()
+        if rank != 0:
+            return None
+    return load_progress(out)
+
+
+def write_catalog(records, out):
+    """
+    Add the successful full (not morphology-only) builds to the catalog,
+    along with their build cost (used for scheduling)
+    """
+    catalog = load_catalog(out)
+    for record in records.values():
+        if record['ok'] and not record['morphology_only']:
+            entry = dict(record['entry'])
+            entry['build_seconds'] = record['seconds']
+            entry['build_rss_mb'] = record['rss_delta_mb']
+            catalog[entry['model_directory']] = entry
+
+    with open(out, 'w') as outfile:
+        json.dump(catalog, outfile, indent=1, sort_keys=True)
+    log.info("Wrote {} cells to {}".format(len(catalog), out))
+
+
+def main(args):
+    with open('cells.json') as infile:
+        cells = json.load(infile)
+
+    comm = None
+    if args.mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+    tasks = [(m_type, e_type, cell_i, args.morphology_only)
+             for (m_type, e_type, cell_i) in iter_cells(cells)
+             if not args.m_type or m_type in args.m_type]
+
+    records = build_all(tasks, args.out, procs=args.procs, comm=comm, retry_failed=args.retry_failed)
+    if records is None:
+        return
+
+    failed = [r for r in records.values() if not r['ok']]
+    log.info("{} cells built, {} failed".format(len(records) - len(failed), len(failed)))
+    for record in failed:
+        log.info("FAILED: {} {} {}".format(record['m_type'], record['e_type'], record['cell_i']))
+
+    if not args.morphology_only:
+        write_catalog(records, args.out)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--out', type=str, default=CATALOG_FILE)
+    parser.add_argument('--m-type', type=str, nargs='+', default=None,
+                        help='only catalog these m-types (default: all of cells.json)')
+    parser.add_argument('--procs', type=int, default=1,
+                        help='number of worker processes (each builds one cell, then exits)')
+    parser.add_argument('--mpi', action='store_true', default=False,
+                        help='divide the cells among MPI ranks instead of using a process pool')
+    parser.add_argument('--morphology-only', action='store_true', default=False,
+                        help='only load each morphology (fast check, does not update the catalog)')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='rebuild cells that failed in a previous run')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
@@ -1,28 +1,40 @@
 """
 Just try instantiating all BBP cells and report the ones that error
+
+Pass --morphology-only to only check that each morphology loads
 """
+from __future__ import print_function
 
-import os
 import json
+import logging as log
+from argparse import ArgumentParser
+
+from cell_catalog import build_all, iter_cells
+
+
+def main(args):
+    with open('cells.json') as infile:
+        cells = json.load(infile)
 
-from neuron import h
+    tasks = [(m_type, e_type, i, args.morphology_only) for (m_type, e_type, i) in iter_cells(cells)]
+    records = build_all(tasks, 'check_BBP', procs=args.procs)
 
-from models import BBP
+    with open('problematic_cells.txt', 'w') as outfile:
+        for record in records.values():
+            if not record['ok']:
+                print(record['m_type'], record['e_type'], record['cell_i'], file=outfile)
+                print(record['error'], file=outfile)
 
-with open('cells.json') as infile:
-    cells = json.load(infile)
 
-h.load_file('import3d.hoc')
-templates_dir = 'hoc_templates'
-with open('problematic_cells.txt', 'w') as outfile:
-    for m_type, etypes in cells.items():
-        for e_type, clones in etypes.items():
-            for i in range(len(clones)):
-                print()
-                print(m_type, e_type, i)
-                print(clones[i])
-                cell = BBP(m_type, e_type, i)
-                cell.create_cell(no_biophys=True)
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--morphology-only', action='store_true', default=False,
+                        help='only check that each morphology loads')
+    parser.add_argument('--procs', type=int, default=4,
+                        help='number of worker processes (each builds one cell, then exits)')
 
+    args = parser.parse_args()
 
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
 
+    main(args)
@@ -35,10 +35,21 @@ EFEL_FEATURES = ['mean_frequency', 'time_to_first_spike', 'mean_AP_amplitude']
 
 class Similarity(object):
     def __init__(self, modelname, stimfile, *args, **kwargs):
+        """
+        server: a sim_server.SimClient (or the socket of a running sim_server.py)
+        to simulate on, instead of building the model in this process
+        """
         self.modelname = modelname
         self.model_cls = MODELS_BY_NAME[modelname]
+        self.stimfile = stimfile
         self.stim = np.genfromtxt(stimfile) * self.model_cls.STIM_MULTIPLIER
 
+        server = kwargs.pop('server', None)
+        if isinstance(server, str):
+            from sim_server import SimClient
+            server = SimClient(server)
+        self.server = server
+
     def _rangeify(self, params):
         _r = lambda data, _range: (data + 1) * (_range[1] - _range[0])/2.0 + _range[0]
         return [_r(x, _range) for x, _range in zip(params, self.model_cls.PARAM_RANGES)]
@@ -47,12 +58,24 @@ class Similarity(object):
         """
         If unit=True, rangeify first
         """
-        stim = stim or self.stim
-        phys_params = self._rangeify(params) if unit else params
+        return self._data_for_many([params], dt=dt, celsius=celsius, stim=stim, unit=unit)[0]
 
-        x = self.model_cls(*phys_params, log=log, celsius=celsius).simulate(stim, dt=dt)
-        x = x['v'][5500:14500]
-        return x
+    def _data_for_many(self, paramsets, dt=0.02, celsius=37, stim=None, unit=False):
+        """
+        _data_for() for each parameter set, as one batch on self.server if there is one
+        """
+        stim_request = {'stim_file': self.stimfile} if stim is None else {'stim': stim}
+        stim = self.stim if stim is None else stim
+        paramsets = [self._rangeify(params) if unit else params for params in paramsets]
+
+        if self.server is None:
+            traces = [self.model_cls(*phys_params, log=log, celsius=celsius).simulate(stim, dt=dt)
+                      for phys_params in paramsets]
+        else:
+            requests = [dict(stim_request, model=self.modelname, params=list(phys_params), dt=dt, celsius=celsius)
+                        for phys_params in paramsets]
+            traces = self.server.simulate(requests)
+        return [x['v'][5500:14500] for x in traces]
 
     def _make_efel_trace(self, v):
         return {
@@ -237,7 +260,7 @@ class Similarity(object):
 
             
 def main(args):
-    x = Similarity(args.model, 'stims/chirp23a.csv')
+    x = Similarity(args.model, 'stims/chirp23a.csv', server=args.server)
 
     if args.sweepfile:
         if len(args.sweepfile) and os.path.isdir(args.sweepfile):
@@ -273,6 +296,8 @@ if __name__ == '__main__':
     # parser.add_argument('--outfile', type=str, required=False, default=None)
     
     parser.add_argument('--dist', choices=['isi'], default='isi')
+    parser.add_argument('--server', type=str, default=None,
+                        help='socket of a running sim_server.py to simulate on (default: simulate in this process)')
 
     args = parser.parse_args()
 
@@ -8,12 +8,61 @@ from datetime import datetime
 from argparse import ArgumentParser
 from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-from neuron import h, gui
+from neuron import h
+
+# stdrun.hoc is what neuron.gui would have loaded for us (without needing a display)
+h.load_file('stdrun.hoc')
 
 from get_rec_points import get_rec_points
+import morph_cache
+
+# Reason codes for simulations stopped early by a SimMonitor (see BaseModel.simulate())
+STOP_NONE = 0
+STOP_NAN = 1
+STOP_RUNAWAY = 2
+STOP_BLOCK = 3
+
+
+class SimMonitor(object):
+    """
+    Periodically inspects the recorded voltage while the simulation is running,
+    so we can abandon parameter sets that are obviously hopeless
+    """
+    def __init__(self, check_every=50.0, max_v=200.0, block_v=-30.0, block_ms=100.0):
+        self.check_every = check_every # ms between checks
+        self.max_v = max_v # |v| above this is a runaway
+        self.block_v = block_v # sitting above this for block_ms with no repolarization is depolarization block
+        self.block_ms = block_ms
+
+    def check(self, v, checked_up_to, dt):
+        """
+        v is a numpy view of the voltage recorded so far, of which the
+        first checked_up_to points have already been inspected. Return one
+        of the STOP_* codes
+        """
+        new = v[checked_up_to:]
+        if not np.all(np.isfinite(new)):
+            return STOP_NAN
+        if np.any(np.abs(new) > self.max_v):
+            return STOP_RUNAWAY
+        block_pts = int(self.block_ms / dt)
+        if len(v) >= block_pts and np.all(v[-block_pts:] > self.block_v):
+            return STOP_BLOCK
+        return STOP_NONE
+
+
+def _pad_trace(trace, npts):
+    """
+    Pad a trace from an early-stopped simulation out to npts, holding the last finite value
+    """
+    finite = np.isfinite(trace)
+    fill = trace[finite][-1] if np.any(finite) else 0.0
+    padded = np.full(npts, fill, dtype=np.float64)
+    padded[:len(trace)] = np.where(finite, trace, fill)
+    return padded
+
 
 class BaseModel(object):
     def __init__(self, *args, **kwargs):
@@ -36,65 +85,269 @@ class BaseModel(object):
     def param_dict(self):
         return {name: getattr(self, name) for name in self.PARAM_NAMES}
 
-    def init_hoc(self, dt, tstop):
+    def init_hoc(self, dt, tstop, saved_state=None):
         h.tstop = tstop
         h.steps_per_ms = 1./dt
+        h.dt = dt # stdinit() only ever makes dt finer, never coarser
         h.stdinit()
+        if saved_state is not None:
+            # Start from a saved steady state (see equilibrate()) instead of the hoc resting potential
+            saved_state.restore(1)
+            h.t = 0
+            h.fcurrent()
+            h.frecord_init()
+
+    def equilibrate(self, prerun, dt=0.025):
+        """
+        Run for prerun ms with zero injected current and return the final
+        state as a SaveState, to start simulations from with init_hoc().
+        The cell and clamp must exist, but the stimulus must not be attached yet
+        """
+        self.init_hoc(dt, prerun)
+        h.continuerun(prerun)
+        state = h.SaveState()
+        state.save()
+        return state
+
+    def steady_state(self, prerun, dt=0.025):
+        """
+        Build the cell with its current parameters and return its steady
+        state (see equilibrate()), to pass to simulate() as saved_state
+        """
+        h('objref cell')
+        h.cell = self.create_cell()
+        self.detach_stim()
+        self.detach_recordings()
+        self.attach_clamp()
+        return self.equilibrate(prerun, dt)
+
+    def detach_stim(self):
+        """
+        Stop playing the previous stimulus, which would otherwise drive the
+        new clamp (eg during equilibrate()) when the model is reused
+        """
+        if getattr(self, 'stimvals', None) is not None:
+            self.stimvals.play_remove()
+            self.stimvals = None
+
+    def detach_recordings(self):
+        """
+        Stop recording into the previous simulation's vectors, which would
+        otherwise keep recording alongside the new ones when the model is reused
+        """
+        for vec in (getattr(self, 'hoc_vectors', None) or {}).values():
+            vec.play_remove() # also removes a vector from the record list
+        self.hoc_vectors = None
 
     def attach_clamp(self):
         h('objref clamp')
         clamp = h.IClamp(h.cell(0.5))
         clamp.delay = 0
         clamp.dur = h.tstop
+        clamp.amp = 0
         h.clamp = clamp
 
-    def attach_stim(self, stim):
+    def attach_stim(self, stim, dt):
+        """
+        Play stim into the clamp, one value every dt ms (the dt of the simulation, not h.dt)
+        """
         # assign to self to persist it
         self.stimvals = h.Vector().from_python(stim)
-        self.stimvals.play("{} = $1".format(self.stim_variable_str), h.dt)
-
-    def attach_recordings(self, ntimepts):
-        hoc_vectors = {
-            'v': h.Vector(ntimepts),
-            'ina': h.Vector(ntimepts),
-            'ik': h.Vector(ntimepts),
-            'ica': h.Vector(ntimepts),
-            'i_leak': h.Vector(ntimepts),
-            'i_cap': h.Vector(ntimepts),
-        }
-        
-        hoc_vectors['v'].record(h.cell(0.5)._ref_v)
-        hoc_vectors['ina'].record(h.cell(0.5)._ref_ina)
-        hoc_vectors['ica'].record(h.cell(0.5)._ref_ica)
-        hoc_vectors['ik'].record(h.cell(0.5)._ref_ik)
-        hoc_vectors['i_leak'].record(h.cell(0.5).pas._ref_i)
-        hoc_vectors['i_cap'].record(h.cell(0.5)._ref_i_cap)
+        if getattr(self, 'nthread', 1) > 1:
+            # Playing into a statement is not thread safe, so play into a pointer
+            obj, var = self.stim_variable_str.split('.')
+            self.stimvals.play(getattr(getattr(h, obj), '_ref_' + var), dt)
+        else:
+            self.stimvals.play("{} = $1".format(self.stim_variable_str), dt)
+
+    def recordable_variables(self):
+        """
+        {name: function returning a pointer to record} for every variable this model can record
+        """
+        return OrderedDict([
+            ('v', lambda: h.cell(0.5)._ref_v),
+            ('ina', lambda: h.cell(0.5)._ref_ina),
+            ('ik', lambda: h.cell(0.5)._ref_ik),
+            ('ica', lambda: h.cell(0.5)._ref_ica),
+            ('i_leak', lambda: h.cell(0.5).pas._ref_i),
+            ('i_cap', lambda: h.cell(0.5)._ref_i_cap),
+        ])
+
+    def attach_recordings(self, ntimepts, variables=None, soma_only=False):
+        """
+        Record the given variables (all recordable variables if None).
+        soma_only only matters for models with several voltage probes (BBP)
+        """
+        hoc_vectors = OrderedDict()
+        for name, ref in self.recordable_variables().items():
+            if variables is None or name in variables:
+                hoc_vectors[name] = h.Vector(ntimepts)
+                self._record(hoc_vectors[name], ref())
 
         return hoc_vectors
 
-    def simulate(self, stim, dt=0.025):
+    def _record(self, vec, ref):
+        # Record every timestep, or only at the times in self.rec_tvec (see simulate())
+        if getattr(self, 'rec_tvec', None) is None:
+            vec.record(ref)
+        else:
+            vec.record(ref, self.rec_tvec)
+
+    def _monitored_vector(self, hoc_vectors):
+        # Soma voltage: 'v' for the simple models, the first probe for BBP
+        return hoc_vectors['v'] if 'v' in hoc_vectors else next(iter(hoc_vectors.values()))
+
+    def _run_monitored(self, hoc_vectors, monitor):
+        """
+        Equivalent to h.run() (after init_hoc()), but advance in chunks of
+        monitor.check_every ms and stop as soon as the monitor reports a problem
+        """
+        vec = self._monitored_vector(hoc_vectors)
+        checked_up_to = 0
+        while h.t < h.tstop - h.dt/2:
+            h.continuerun(min(h.t + monitor.check_every, h.tstop))
+            v = vec.as_numpy()
+            reason = monitor.check(v, checked_up_to, self.rec_dt)
+            if reason != STOP_NONE:
+                self.log.debug("Stopping early at t = {} ms (reason {})".format(h.t, reason))
+                return reason
+            checked_up_to = len(v)
+        return STOP_NONE
+
+    def _copy_traces(self, hoc_vectors, nrec, out=None):
+        """
+        Convert the recorded hoc vectors to numpy.
+
+        Without out, return an OrderedDict of copies. With out (an array of
+        shape (nrec,) or (nrec, nprobes), typically a row of the caller's
+        output buffer), copy the voltage trace(s) straight into it from
+        views of the hoc vectors, and return those views rather than copies
+        (valid until the next simulate(), see detach_recordings())
+        """
+        traces = OrderedDict()
+        for k, v in hoc_vectors.items():
+            if self.stop_reason != STOP_NONE:
+                traces[k] = _pad_trace(np.array(v), nrec)
+            else:
+                traces[k] = v.as_numpy() if out is not None else np.array(v)
+
+        if out is not None:
+            if out.ndim == 1:
+                out[:] = traces[next(iter(traces))][:len(out)]
+            else:
+                for j, trace in enumerate(traces.values()):
+                    out[:, j] = trace[:len(out)]
+
+        return traces
+
+    def simulate(self, stim, dt=0.025, monitor=None, variables=None, soma_only=False, rec_window=None,
+                 out=None, prerun=0, saved_state=None):
+        """
+        rec_window: (first, stop, step) in units of timesteps. If given,
+        only record every step'th timestep in [first, stop) rather than
+        every timestep of the run
+
+        out: optional array to write the voltage trace(s) into (see _copy_traces())
+
+        prerun: if nonzero, first relax the cell for this many ms at zero
+        current (see equilibrate()) and start the stimulus from there.
+        saved_state: a state from steady_state() to start from instead
+        """
         _start = datetime.now()
         
         ntimepts = len(stim)
         tstop = ntimepts * dt
         # self.init_hoc(dt, tstop)
 
+        if rec_window is None:
+            self.rec_tvec = None
+            self.rec_dt = dt
+            nrec = ntimepts + 1 # A full run records one point more than the stimulus
+        else:
+            first, stop, step = rec_window
+            rec_times = (first + step * np.arange(len(range(first, stop, step)))) * dt
+            self.rec_tvec = h.Vector().from_python(rec_times)
+            self.rec_dt = step * dt
+            nrec = len(rec_times)
+
+        h.tstop = tstop # the clamp duration is set from it
         h('objref cell')
         h.cell = self.create_cell()
+        self.detach_stim() # the prerun must see zero current, not the last sample's stimulus
+        self.detach_recordings()
         self.attach_clamp()
-        self.attach_stim(stim)
-        hoc_vectors = self.attach_recordings(ntimepts)
+        if prerun and saved_state is None:
+            saved_state = self.equilibrate(prerun, dt)
+        self.attach_stim(stim, dt)
+        hoc_vectors = self.attach_recordings(nrec, variables=variables, soma_only=soma_only)
 
-        self.init_hoc(dt, tstop)
+        self.init_hoc(dt, tstop, saved_state)
 
         self.log.debug("Running simulation for {} ms with dt = {}".format(h.tstop, h.dt))
         self.log.debug("({} total timesteps)".format(ntimepts))
 
-        h.run()
+        if monitor is None:
+            h.continuerun(h.tstop) # init_hoc() has already initialized
+            self.stop_reason = STOP_NONE
+        else:
+            self.stop_reason = self._run_monitored(hoc_vectors, monitor)
 
         self.log.debug("Time to simulate: {}".format(datetime.now() - _start))
 
-        return OrderedDict([(k, np.array(v)) for (k, v) in hoc_vectors.items()])
+        # Keep the vectors alive for the views returned by _copy_traces(), until the next run
+        self.hoc_vectors = hoc_vectors
+
+        return self._copy_traces(hoc_vectors, nrec, out=out)
+
+
+def _parse_um_range(spec):
+    # '50-200um' -> (50.0, 200.0)
+    lo, hi = spec[:-len('um')].split('-')
+    return float(lo), float(hi)
+
+
+def select_probes(probe_names, spec=None, distances=None):
+    """
+    Choose a subset of the BBP recording points, given their names (as
+    returned by BBP.get_all_probe_names()), their path distances from the
+    soma in um (BBP.get_all_probe_distances()) and a list of selectors:
+      'soma': the soma
+      'axon:N': N axonal probes, evenly spaced by distance from the soma
+      'dend:N': the same for the dendritic (basal or apical) probes
+      'axon:50-200um', 'dend:50-200um': every axonal or dendritic probe
+        between those distances from the soma (inclusive)
+      anything else: the probe with that name, eg 'axon_12' or 'apic_3'
+    The soma is always included since QA is done on it. spec=None selects
+    everything.
+
+    Return the indices of the selected probes, in their original order
+    """
+    if not spec:
+        return list(range(len(probe_names)))
+
+    sec_types = [name.split('_')[0] for name in probe_names]
+    selected = {0}
+    for selector in spec:
+        if ':' in selector:
+            if distances is None:
+                raise ValueError("Probe selector '{}' needs the probe distances".format(selector))
+            sec_type, count = selector.split(':')
+            types = ('dend', 'apic') if sec_type == 'dend' else (sec_type,)
+            matches = sorted((distances[i], i) for i, t in enumerate(sec_types) if t in types)
+            if count.endswith('um'):
+                lo, hi = _parse_um_range(count)
+                selected.update(i for dist, i in matches if lo <= dist <= hi)
+            elif matches:
+                n = min(int(count), len(matches))
+                # Spread over the distances, from the nearest to the farthest probe
+                picks = np.linspace(0, len(matches) - 1, n) if n > 1 else [0]
+                selected.update(matches[int(round(k))][1] for k in picks)
+        elif selector in probe_names:
+            selected.add(probe_names.index(selector))
+        else:
+            raise ValueError("Unknown probe '{}'".format(selector))
+
+    return sorted(selected)
 
 
 class BBP(BaseModel):
@@ -110,85 +363,178 @@ class BBP(BaseModel):
         # If args are not passed in, we use default arguments. The value of self.use_defaults is checked in BBP.create_cell()
         self.use_defaults = (len(args) == 0)
 
+        # Which of the recording points to record from (see select_probes())
+        self.probe_spec = kwargs.pop('probes', None)
+
+        # Load the templates from morph_cache/ if this cell has been converted (see morph_cache.py)
+        self.use_morph_cache = kwargs.pop('morph_cache', True)
+        self.template_dir = kwargs.pop('template_dir', None)
+
+        # Threads to run this cell on, and whether to split it among them (see _setup_threads())
+        self.nthread = kwargs.pop('nthread', 1)
+        self.multisplit = kwargs.pop('multisplit', False)
+
         super(BBP, self).__init__(*args, **kwargs)
 
     STIM_MULTIPLIER = 1.0
 
+    def _get_all_rec_pts(self):
+        if getattr(self, '_all_rec_pts', None) is None:
+            self._all_rec_pts = list(OrderedDict.fromkeys(get_rec_points(self.entire_cell)))
+        return self._all_rec_pts
+
     def _get_rec_pts(self):
-        if not hasattr(self, 'probes'):
-            self.probes = list(OrderedDict.fromkeys(get_rec_points(self.entire_cell)))
+        if getattr(self, 'probes', None) is None:
+            idx = select_probes(self.get_all_probe_names(), self.probe_spec, self.get_all_probe_distances())
+            self.probes = [self._get_all_rec_pts()[i] for i in idx]
         return self.probes
         
     def _n_rec_pts(self):
         return len(self._get_rec_pts())
 
-    def attach_recordings(self, ntimepts):
+    def attach_recordings(self, ntimepts, variables=None, soma_only=False):
+        # Only the voltage is recorded from BBP cells, at each probe
         hoc_vectors = OrderedDict()
-        for sec in self._get_rec_pts():
+        rec_pts = self._get_rec_pts()[:1] if soma_only else self._get_rec_pts()
+        for sec in rec_pts:
             hoc_vectors[sec.hname()] = h.Vector(ntimepts)
-            hoc_vectors[sec.hname()].record(sec(0.5)._ref_v)
+            self._record(hoc_vectors[sec.hname()], sec(0.5)._ref_v)
 
         return hoc_vectors
 
     def create_cell(self):
+        if getattr(self, 'entire_cell', None) is not None:
+            # Already built, and set_params() keeps the parameters up to date
+            return self.entire_cell.soma[0]
+
         h.load_file('stdrun.hoc')
-        h.load_file('import3d.hoc')
         cell_dir = self.cell_kwargs['model_directory']
         log.debug("cell_dir = {}".format(cell_dir))
         template_name = self.cell_kwargs['model_template'].split(':', 1)[-1]
-        templates_dir = 'hoc_templates'
+        template_dir = self.template_dir or morph_cache.template_dir(cell_dir, self.use_morph_cache)
+        if template_dir.startswith(morph_cache.TEMPLATES_DIR):
+            h.load_file('import3d.hoc')
         
-        constants = '/'.join([templates_dir, cell_dir, 'constants.hoc'])
+        constants = '/'.join([template_dir, 'constants.hoc'])
         log.debug(constants)
         h.load_file(constants)
 
-        morpho_template = '/'.join([templates_dir, cell_dir, 'morphology.hoc'])
+        morpho_template = '/'.join([template_dir, 'morphology.hoc'])
         log.debug(morpho_template)
         h.load_file(morpho_template)
         
-        biophys_template = '/'.join([templates_dir, cell_dir, 'biophysics.hoc'])
+        biophys_template = '/'.join([template_dir, 'biophysics.hoc'])
         log.debug(biophys_template)
         h.load_file(biophys_template)
         
-        synapse_template = '/'.join([templates_dir, cell_dir, 'synapses/synapses.hoc'])
+        synapse_template = '/'.join([template_dir, 'synapses/synapses.hoc'])
         log.debug(synapse_template)
         h.load_file(synapse_template)
         
-        cell_template = '/'.join([templates_dir, cell_dir, 'template.hoc'])
+        cell_template = '/'.join([template_dir, 'template.hoc'])
         log.debug(cell_template)
         h.load_file(cell_template)
         
         # For some reason, need to instantiate cell from within the templates directory?
         cwd = os.getcwd()
-        os.chdir(os.path.join(templates_dir, cell_dir))
+        os.chdir(template_dir)
         
         SYNAPSES, NO_SYNAPSES = 1, 0
         hobj = getattr(h, template_name)(NO_SYNAPSES)
         self.entire_cell = hobj # do not garbage collect
+        # The template deletes all previous sections
+        self._all_rec_pts = self.probes = self._all_probe_names = self._all_probe_distances = None
 
         os.chdir(cwd)
 
+        self._build_param_index()
+
         # assign self.PARAM_RANGES and self.DEFAULT_PARAMS
-        self.PARAM_RANGES, self.DEFAULT_PARAMS = [], []
-        for name, sec, param_name, seclist in self.iter_name_sec_param_name_seclist():
-            default = getattr(seclist[0], name, -1)
-            self.DEFAULT_PARAMS.append(default)
-            self.PARAM_RANGES.append((default/10.0, default*10.0) if default != -1 else (0, 0))
-        self.DEFAULT_PARAMS = tuple(self.DEFAULT_PARAMS)
-        self.PARAM_RANGES = tuple(self.PARAM_RANGES)
+        self.DEFAULT_PARAMS = tuple(default for _, _, _, default in self._param_index)
+        self.PARAM_RANGES = tuple((default/10.0, default*10.0) if default != -1 else (0, 0)
+                                  for default in self.DEFAULT_PARAMS)
 
         # change biophysics parameters
         if not self.use_defaults:
-            for name, sec, param_name, seclist in self.iter_name_sec_param_name_seclist():
-                for sec in seclist:
-                    if hasattr(sec, name):
-                        setattr(sec, name, getattr(self, param_name))
-                    else:
-                        log.debug("Not setting {} (absent from this cell)".format(param_name))
-                        continue
+            self._apply_params()
+
+        if self.nthread > 1:
+            self._setup_threads()
 
         return hobj.soma[0]
 
+    def _setup_threads(self):
+        """
+        Run on self.nthread threads. A single cell only uses more than one
+        thread if it is split: with self.multisplit, each subtree attached to
+        the soma becomes a separate piece, joined back by pc.multisplit() and
+        divided among the threads. If this NEURON does not support
+        multisplit, the cell is reconnected and runs unsplit
+        """
+        pc = h.ParallelContext()
+        pc.nthread(self.nthread)
+        h.CVode().cache_efficient(1)
+        if not self.multisplit:
+            return
+
+        self._get_all_rec_pts() # walks the tree, so do it before splitting
+        soma = self.entire_cell.soma[0]
+        children = [(child, child.parentseg().x, child.orientation()) for child in soma.children()]
+        sids = {}
+        try:
+            for child, x, orientation in children:
+                sid = sids.setdefault(x, len(sids))
+                h.disconnect(sec=child)
+                pc.multisplit(orientation, sid, sec=child)
+            for x, sid in sids.items():
+                pc.multisplit(x, sid, sec=soma)
+            pc.multisplit()
+        except RuntimeError as e:
+            log.warning("multisplit failed ({}), running the cell unsplit".format(e))
+            for child, x, orientation in children:
+                if child.parentseg() is None:
+                    child.connect(soma(x), orientation)
+
+    def _build_param_index(self):
+        """
+        Build self._param_index: for each parameter, (name, param_name, the
+        sections it is present in, its default value) where the default is
+        its value in the first section of its section list (or -1 if absent
+        from there). Computed once per cell, so setting parameters is one
+        pass over the index
+        """
+        self._seclists = {key: list(getattr(self.entire_cell, key))
+                          for key in ('apical', 'basal', 'somatic', 'axonal')}
+        self._param_index = []
+        for name, sec, param_name, seclist in self.iter_name_sec_param_name_seclist():
+            present = [s for s in seclist if hasattr(s, name)]
+            if len(present) < len(seclist):
+                log.debug("{} is absent from {} of {} sections".format(
+                    param_name, len(seclist) - len(present), len(seclist)))
+            default = getattr(seclist[0], name, -1)
+            self._param_index.append((name, param_name, present, default))
+
+    def _apply_params(self):
+        for name, param_name, present, _ in self._param_index:
+            value = getattr(self, param_name)
+            for sec in present:
+                setattr(sec, name, value)
+
+    def set_params(self, *params):
+        """
+        Change the parameters of an existing cell in place, rather than
+        building a new one. Falls back to building a new cell for the
+        default parameters, since the template may not set them uniformly.
+        Only valid until another BBP cell is built in this process (the
+        templates delete all existing sections)
+        """
+        self._set_self_params(*params)
+        self.use_defaults = (len(params) == 0)
+        if self.use_defaults:
+            self.entire_cell = None
+        elif getattr(self, 'entire_cell', None) is not None:
+            self._apply_params()
+
     def iter_name_sec_param_name(self):
         """
         The param_names for the BBP model are <parameter>_<section>
@@ -205,16 +551,10 @@ class BBP(BaseModel):
         where seclist is a Python list of the Neuron segments in that section
         """
         for name, sec, param_name in self.iter_name_sec_param_name():
-            if sec == 'apical':
-                seclist = list(self.entire_cell.apical)
-            elif sec == 'basal':
-                seclist = list(self.entire_cell.basal)
-            elif sec == 'dend':
-                seclist = list(self.entire_cell.basal) + list(self.entire_cell.apical)
-            elif sec == 'somatic':
-                seclist = list(self.entire_cell.somatic)
-            elif sec == 'axonal':
-                seclist = list(self.entire_cell.axonal)
+            if sec == 'dend':
+                seclist = self._seclists['basal'] + self._seclists['apical']
+            elif sec in self._seclists:
+                seclist = self._seclists[sec]
             else:
                 raise NotImplementedError("Unrecognized section identifier: {}".format(sec))
 
@@ -225,17 +565,28 @@ class BBP(BaseModel):
         Get a list of booleans denoting whether each parameter is varied in this cell or not
         A parameter is varied if 1.) it is present in the section, and 2.) its value is nonzero
         """
-        boolarray = []
-        for name, sec, param_name, seclist in self.iter_name_sec_param_name_seclist():
-            boolarray.append(getattr(seclist[0], name, 0) != 0)
-        return boolarray
+        return [default not in (-1, 0) for _, _, _, default in self._param_index]
+
+    def get_all_probe_names(self):
+        # Cached, so the names are still available after another cell has deleted these sections
+        if getattr(self, '_all_probe_names', None) is None:
+            self._all_probe_names = ['soma'] + \
+                [
+                    sec.hname().rsplit('.')[-1].replace('[', '_').replace(']', '')
+                    for sec in self._get_all_rec_pts()[1:]
+                ]
+        return self._all_probe_names
+
+    def get_all_probe_distances(self):
+        # Path distance (um) from the middle of the soma to the middle of each probe's section, cached
+        if getattr(self, '_all_probe_distances', None) is None:
+            soma = self.entire_cell.soma[0](0.5)
+            self._all_probe_distances = [h.distance(soma, sec(0.5)) for sec in self._get_all_rec_pts()]
+        return self._all_probe_distances
 
     def get_probe_names(self):
-        return ['soma'] + \
-            [
-                sec.hname().rsplit('.')[-1].replace('[', '_').replace(']', '')
-                for sec in self._get_rec_pts()[1:]
-            ]
+        all_names = self.get_all_probe_names()
+        return [all_names[i] for i in select_probes(all_names, self.probe_spec, self.get_all_probe_distances())]
         
 
 class BBPInh(BBP):
@@ -296,6 +647,10 @@ class BBPExc(BBP):
     )
 
 
+def bbp_class(e_type):
+    return BBPExc if e_type == 'cADpyr' else BBPInh
+
+
 class Mainen(BaseModel):
     PARAM_NAMES = (
         'gna_dend',
@@ -390,10 +745,10 @@ class Izhi(BaseModel):
     def attach_clamp(self):
         self.log.debug("Izhi cell, not using IClamp")
 
-    def attach_recordings(self, ntimepts):
-        vec = h.Vector(ntimepts)
-        vec.record(h.cell._ref_V) # Capital V because it's not the real membrane voltage
-        return {'v': vec}
+    def recordable_variables(self):
+        return OrderedDict([
+            ('v', lambda: h.cell._ref_V), # Capital V because it's not the real membrane voltage
+        ])
 
 
 class HHPoint5Param(BaseModel):
@@ -483,13 +838,10 @@ class HHBallStick7Param(BaseModel):
 
         return soma
 
-    def attach_recordings(self, ntimepts):
-        hoc_vectors = super(HHBallStick7Param, self).attach_recordings(ntimepts)
-
-        hoc_vectors['v_dend'] = h.Vector(ntimepts)
-        hoc_vectors['v_dend'].record(self.dend(1)._ref_v) # record from distal end of stick
-        
-        return hoc_vectors
+    def recordable_variables(self):
+        recordable = super(HHBallStick7Param, self).recordable_variables()
+        recordable['v_dend'] = lambda: self.dend(1)._ref_v # record from distal end of stick
+        return recordable
 
 
 class HHBallStick9Param(HHBallStick7Param):
@@ -652,6 +1004,8 @@ MODELS_BY_NAME = {
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     # When executed as a script, this will generate and display traces of the given model at the given params (or its defaults) and overlay a trace with the params shifted 1 rmse
     # parser = ArgumentParser()
 
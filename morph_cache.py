@@ -0,0 +1,288 @@
+"""
+Pre-converted BBP morphologies, so cells can be built without import3d
+
+Every BBP template parses its .asc morphology through import3d.hoc when it
+is instantiated, which is most of the time spent in BBP.create_cell(). This
+converts each template's morphology once into a plain hoc morphology.hoc
+(sections, connections and pt3d points, split into small procs like the
+CellBuilder exports) with the same template name, and puts it in
+morph_cache/<model_directory>/ next to copies of the other template files.
+BBP.create_cell() loads the cell from there when it exists.
+
+Each converted cell is checked against the import3d version (section tree,
+section lists, nseg and segment areas); cells that do not match are not
+cached. Build the cache with:
+
+$ python morph_cache.py --procs 8
+"""
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import logging as log
+from argparse import ArgumentParser
+
+CACHE_DIR = 'morph_cache'
+TEMPLATES_DIR = 'hoc_templates'
+
+SECTION_LISTS = ('all', 'somatic', 'axonal', 'basal', 'apical')
+COUNTS = ('nSecSoma', 'nSecApical', 'nSecBasal', 'nSecAxonal', 'nSecAll', 'nSecAxonalOrig')
+TEMPLATE_FILES = ('constants.hoc', 'biophysics.hoc', 'template.hoc', 'synapses')
+
+PTS_PER_PROC = 200 # keep each generated proc small
+
+
+def template_dir(cell_dir, use_cache=True):
+    """
+    The directory to load the templates for cell_dir (a model_directory in cells.json) from
+    """
+    cached = os.path.join(CACHE_DIR, cell_dir)
+    if use_cache and os.path.exists(os.path.join(cached, 'morphology.hoc')):
+        return cached
+    return os.path.join(TEMPLATES_DIR, cell_dir)
+
+
+def _local_name(sec):
+    # 'cADpyr232_L5_TTPC1_0fb1ca4724[0].dend[3]' -> 'dend[3]'
+    return sec.hname().rsplit('.', 1)[-1]
+
+
+def cell_signature(hobj):
+    """
+    Everything about an instantiated cell that the cached morphology must reproduce
+    """
+    sections = []
+    for sec in hobj.all:
+        parent = sec.parentseg()
+        sections.append({
+            'name': _local_name(sec),
+            'parent': _local_name(parent.sec) if parent is not None else None,
+            'parent_x': parent.x if parent is not None else None,
+            'orientation': sec.orientation(),
+            'nseg': sec.nseg,
+            'areas': [seg.area() for seg in sec],
+        })
+    lists = {name: [_local_name(sec) for sec in getattr(hobj, name)] for name in SECTION_LISTS}
+    return {'sections': sections, 'lists': lists}
+
+
+def compare_signatures(expected, actual, rtol=1e-6):
+    """
+    Return a list of differences (empty if the cells match)
+    """
+    errors = []
+    if expected['lists'] != actual['lists']:
+        errors.append("section lists differ")
+    if len(expected['sections']) != len(actual['sections']):
+        return errors + ["{} sections, expected {}".format(
+            len(actual['sections']), len(expected['sections']))]
+    for exp, act in zip(expected['sections'], actual['sections']):
+        for key in ('name', 'parent', 'parent_x', 'orientation', 'nseg'):
+            if exp[key] != act[key]:
+                errors.append("{} {}: {} != {}".format(exp['name'], key, act[key], exp[key]))
+        if exp['nseg'] == act['nseg']:
+            for a, b in zip(exp['areas'], act['areas']):
+                if abs(a - b) > rtol * max(abs(a), abs(b)):
+                    errors.append("{} segment areas differ".format(exp['name']))
+                    break
+    return errors
+
+
+def morphology_hoc(hobj, morph_template):
+    """
+    Write out the morphology of an instantiated cell as a hoc template named
+    morph_template, whose morphology($o1) proc rebuilds it without import3d
+    """
+    secs = list(hobj.all)
+    names = [_local_name(sec) for sec in secs]
+
+    sizes = {}
+    for name in names:
+        sec_type, i = name.rstrip(']').split('[')
+        sizes[sec_type] = max(sizes.get(sec_type, 0), int(i) + 1)
+
+    procs = [] # bodies of the generated shape procs
+    body = []
+    npts = 0
+    for sec, name in zip(secs, names):
+        body.append('  $o1.{} {{ pt3dclear()'.format(name))
+        for i in range(int(sec.n3d())):
+            body.append('    pt3dadd({!r}, {!r}, {!r}, {!r})'.format(
+                sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.diam3d(i)))
+            npts += 1
+            if npts % PTS_PER_PROC == 0:
+                body.append('  }')
+                procs.append(body)
+                body = ['  $o1.{} {{'.format(name)]
+        body.append('  }')
+    procs.append(body)
+
+    lines = [
+        '// Generated by morph_cache.py from the import3d morphology, do not edit',
+        '',
+        'begintemplate {}'.format(morph_template),
+        'public morphology',
+        '',
+        'proc morphology() {',
+    ]
+    lines += ['  execute1("create {}[{}]", $o1)'.format(sec_type, n) for sec_type, n in sorted(sizes.items())]
+    lines += ['  shape3d_{}($o1)'.format(i) for i in range(len(procs))]
+    lines += ['  connections($o1)', '  lists($o1)']
+    for count in COUNTS:
+        if hasattr(hobj, count):
+            lines.append('  $o1.{} = {}'.format(count, int(getattr(hobj, count))))
+    lines.append('}')
+
+    for i, proc in enumerate(procs):
+        lines += ['', 'proc shape3d_{}() {{'.format(i)] + proc + ['}']
+
+    lines += ['', 'proc connections() {']
+    for sec, name in zip(secs, names):
+        parent = sec.parentseg()
+        if parent is not None:
+            lines.append('  $o1.{} connect $o1.{}({}), {!r}'.format(
+                _local_name(parent.sec), name, sec.orientation(), parent.x))
+    lines.append('}')
+
+    lines += ['', 'proc lists() {']
+    for list_name in SECTION_LISTS:
+        for sec in getattr(hobj, list_name):
+            lines.append('  $o1.{} {{ $o1.{}.append() }}'.format(_local_name(sec), list_name))
+    lines.append('}')
+
+    lines += ['', 'endtemplate {}'.format(morph_template), '']
+    return '\n'.join(lines)
+
+
+def _morph_template_name(cell_dir):
+    # The template.hoc of each cell instantiates "new morphology_<hash>()"
+    with open(os.path.join(TEMPLATES_DIR, cell_dir, 'morphology.hoc')) as infile:
+        for line in infile:
+            if line.startswith('begintemplate'):
+                return line.split()[1]
+    raise ValueError("No template in {}/morphology.hoc".format(cell_dir))
+
+
+def convert_one(task):
+    """
+    Convert the morphology of one cell into morph_cache/ (staged in a
+    temporary directory until verify_one() accepts it). Run in a fresh
+    process, since hoc templates cannot be loaded twice.
+    Return the import3d cell signature
+    """
+    import models
+
+    m_type, e_type, cell_i, cell_dir = task
+    staging = os.path.join(CACHE_DIR, cell_dir + '.tmp')
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    model = models.bbp_class(e_type)(m_type, e_type, cell_i, log=log, morph_cache=False)
+    model.create_cell()
+    hobj = model.entire_cell
+    with open(os.path.join(staging, 'morphology.hoc'), 'w') as outfile:
+        outfile.write(morphology_hoc(hobj, _morph_template_name(cell_dir)))
+    for name in TEMPLATE_FILES:
+        src = os.path.join(TEMPLATES_DIR, cell_dir, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(staging, name))
+        else:
+            shutil.copy(src, staging)
+
+    return cell_signature(hobj)
+
+
+def verify_one(task):
+    """
+    Build one cell from its staged cached morphology and return its
+    signature. Run in a fresh process
+    """
+    import models
+
+    m_type, e_type, cell_i, cell_dir = task
+    staging = os.path.join(CACHE_DIR, cell_dir + '.tmp')
+    model = models.bbp_class(e_type)(m_type, e_type, cell_i, log=log, template_dir=staging)
+    model.create_cell()
+    return cell_signature(model.entire_cell)
+
+
+def cache_one(task):
+    """
+    Convert, verify and (if it matches) install the cached morphology for one cell.
+    Return (task, list of errors)
+    """
+    import multiprocessing
+    import traceback
+
+    cell_dir = task[-1]
+    staging = os.path.join(CACHE_DIR, cell_dir + '.tmp')
+    try:
+        # One fresh process for each build
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        expected = pool.apply(convert_one, (task,))
+        actual = pool.apply(verify_one, (task,))
+        pool.close()
+        pool.join()
+        errors = compare_signatures(expected, actual)
+    except Exception:
+        errors = [traceback.format_exc()]
+
+    if errors:
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+    else:
+        final = os.path.join(CACHE_DIR, cell_dir)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(staging, final)
+    return task, errors
+
+
+def main(args):
+    from cell_catalog import iter_cells
+
+    with open('cells.json') as infile:
+        cells = json.load(infile)
+
+    tasks = []
+    for m_type, e_type, cell_i in iter_cells(cells):
+        cell_dir = cells[m_type][e_type][cell_i]['model_directory']
+        if args.m_type and m_type not in args.m_type:
+            continue
+        if not args.force and template_dir(cell_dir) != os.path.join(TEMPLATES_DIR, cell_dir):
+            continue
+        tasks.append((m_type, e_type, cell_i, cell_dir))
+    log.info("Caching {} morphologies".format(len(tasks)))
+
+    if args.procs > 1:
+        # cache_one() starts its own worker processes, so use threads here
+        from multiprocessing.pool import ThreadPool
+        results = ThreadPool(args.procs).imap_unordered(cache_one, tasks)
+    else:
+        results = map(cache_one, tasks)
+
+    nfailed = 0
+    for (m_type, e_type, cell_i, cell_dir), errors in results:
+        if errors:
+            nfailed += 1
+            log.warning("{} not cached:\n{}".format(cell_dir, '\n'.join(errors)))
+        else:
+            log.info("Cached {}".format(cell_dir))
+    log.info("{} cached, {} failed".format(len(tasks) - nfailed, nfailed))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--m-type', type=str, nargs='+', default=None,
+                        help='only cache these m-types (default: all of cells.json)')
+    parser.add_argument('--procs', type=int, default=1, help='number of cells to convert at once')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='reconvert cells that are already cached')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
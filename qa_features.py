@@ -0,0 +1,85 @@
+"""
+Vectorized QA over a whole block of voltage traces at once
+
+batch_qa() computes per-sample, per-probe summary features plus a QA
+bitmask, so downstream filtering does not need to decode the int16
+voltages. Only numpy is needed.
+"""
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+# Bits of the qaMask dataset
+QA_SPIKING = 1 # soma crosses the threshold at least once (same as binQA)
+QA_CLIPPED = 2 # some probe goes outside the range representable in the int16 voltages
+QA_NONFINITE = 4 # NaN or inf somewhere in the trace
+QA_DEPOLARIZED = 8 # soma ends the trace above threshold (eg depolarization block)
+QA_STOPPED = 16 # simulation was stopped early (see run.py --early-stop and the stopQA dataset)
+
+# Per-sample, per-probe feature datasets and their dtypes
+FEATURE_DTYPES = OrderedDict([
+    ('spikeCount', np.int16),
+    ('firstSpikeTime', np.float32), # ms from the start of the simulation, or -1 if the probe never crosses the threshold
+    ('vMin', np.float32),
+    ('vMax', np.float32),
+    ('vMean', np.float32),
+])
+
+
+def batch_qa(v, dt, thresh=-10, volts_scale=None, tstart=0, stop_reason=None):
+    """
+    v: voltages in mV, shape (samples, time) or (samples, time, probes).
+    Probe 0 is taken to be the soma.
+    tstart: time (ms) of the first recorded point
+    stop_reason: optional per-sample stopQA codes; nonzero sets QA_STOPPED
+
+    Return an OrderedDict of {dataset name: array}, with the features in
+    FEATURE_DTYPES of shape (samples, probes) and qaMask of shape (samples,)
+    """
+    if v.ndim == 2:
+        v = v[:, :, np.newaxis]
+
+    finite = np.isfinite(v)
+    above = v > thresh
+    onsets = above[:, 1:, :] & ~above[:, :-1, :] # same definition as run._qa()
+    spike_count = onsets.sum(axis=1)
+    first_spike = np.where(spike_count > 0, tstart + (onsets.argmax(axis=1) + 1) * dt, -1)
+
+    v_finite = np.where(finite, v, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN traces
+        v_min = np.nanmin(v_finite, axis=1)
+        v_max = np.nanmax(v_finite, axis=1)
+        v_mean = np.nanmean(v_finite, axis=1)
+
+    mask = np.zeros(v.shape[0], dtype=np.uint8)
+    mask[spike_count[:, 0] > 0] |= QA_SPIKING
+    if volts_scale is not None:
+        mask[np.any(np.abs(v_finite) * volts_scale > 32767, axis=(1, 2))] |= QA_CLIPPED
+    mask[~np.all(finite, axis=(1, 2))] |= QA_NONFINITE
+    mask[v[:, -1, 0] > thresh] |= QA_DEPOLARIZED
+    if stop_reason is not None:
+        mask[np.asarray(stop_reason) != 0] |= QA_STOPPED
+
+    features = OrderedDict()
+    for name, data in zip(FEATURE_DTYPES, (spike_count, first_spike, v_min, v_max, v_mean)):
+        features[name] = data.astype(FEATURE_DTYPES[name])
+    features['qaMask'] = mask
+    return features
+
+
+def bin_qa(mask):
+    """
+    binQA from qaMask: the soma spikes and the simulation ran to the end
+    """
+    return ((mask & QA_SPIKING) > 0) & ((mask & QA_STOPPED) == 0)
+
+
+def create_qa_datasets(f, nsamples, nprobes):
+    """
+    Create (or open, if they already exist) the datasets written by batch_qa() in the h5 file f
+    """
+    for name, dtype in FEATURE_DTYPES.items():
+        f.require_dataset(name, shape=(nsamples, nprobes), maxshape=(None, nprobes), chunks=True, dtype=dtype)
+    f.require_dataset('qaMask', shape=(nsamples,), maxshape=(None,), chunks=True, dtype=np.uint8)
@@ -0,0 +1,126 @@
+"""
+Read run.py output files, including files that are still being written
+
+Files written with run.py --swmr can be opened while the simulation is
+running (HDF5 single-writer/multiple-reader mode). Their nValid dataset
+counts the rows written so far; read_valid() returns only those:
+
+>>> import readers
+>>> data = readers.read_valid('results.h5', ['voltages', 'binQA', 'phys_par'])
+>>> data['voltages'].shape[0] == data['nValid']
+True
+
+QA features other than binQA (see qa_features.py) are only filled in once
+the run is complete.
+
+Voltages are stored as integers; decode_volts() turns them back into mV
+whichever quantization (run.py --quantize) the file was written with.
+"""
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import h5py
+
+DEFAULT_DATASETS = ('voltages', 'binQA', 'phys_par', 'norm_par')
+VOLTS_SCALE = 150 # the fixed scale of files written before --quantize
+
+
+def open_file(filename):
+    """
+    Open an output file for reading, as a SWMR reader if it was written with --swmr
+    """
+    try:
+        return h5py.File(filename, 'r', libver='latest', swmr=True)
+    except (IOError, OSError, ValueError):
+        return h5py.File(filename, 'r')
+
+
+def n_valid(f):
+    """
+    Number of rows of the file that have been written
+    """
+    if 'nValid' in f:
+        f['nValid'].refresh()
+        return int(f['nValid'][0])
+    if f.attrs.get('complete', False):
+        return f['voltages'].shape[0]
+    return 0
+
+
+def is_complete(f):
+    if f.attrs.get('complete', False):
+        return True
+    return 'nValid' in f and n_valid(f) == f['voltages'].shape[0]
+
+
+def _str(x):
+    return x.decode() if isinstance(x, bytes) else x
+
+
+def quantization(f):
+    """
+    'global' (one fixed scale), 'probe' (a scale and offset per probe) or
+    'sample' (a scale and offset per sample and probe)
+    """
+    return _str(f['voltages'].attrs.get('quantization', 'global'))
+
+
+def decode_volts(f, start=0, stop=None):
+    """
+    Voltages (mV) of samples [start, stop) of the open output file f, as float32
+    """
+    mode = quantization(f)
+    q = f['voltages'][start:stop, ...].astype(np.float32)
+    if mode == 'global':
+        return q / f['voltages'].attrs.get('voltsScale', VOLTS_SCALE)
+
+    if f.swmr_mode:
+        f['voltsScale'].refresh()
+        f['voltsOffset'].refresh()
+    if mode == 'probe':
+        scale, offset = f['voltsScale'][()], f['voltsOffset'][()]
+    else:
+        # Per sample: insert the time axis to broadcast against (samples, time[, probes])
+        scale = np.expand_dims(f['voltsScale'][start:stop], 1)
+        offset = np.expand_dims(f['voltsOffset'][start:stop], 1)
+    return q / scale + offset
+
+
+def read_valid(filename, datasets=DEFAULT_DATASETS, start=0, decode=True):
+    """
+    Return {name: rows [start, nValid) of the dataset} for the given
+    per-sample datasets, plus 'nValid'. If decode, voltages are in mV
+    (see decode_volts()), otherwise as stored
+    """
+    with open_file(filename) as f:
+        n = n_valid(f)
+        data = {'nValid': n}
+        for name in datasets:
+            dset = f[name]
+            if f.swmr_mode:
+                dset.refresh()
+            if name == 'voltages' and decode:
+                data[name] = decode_volts(f, start, n)
+            else:
+                data[name] = dset[start:n]
+    return data
+
+
+def follow(filename, datasets=DEFAULT_DATASETS, poll=10.0, decode=True):
+    """
+    Yield the new rows (as from read_valid()) of a file that is being
+    written, every poll seconds, until it is complete
+    """
+    done = 0
+    while True:
+        with open_file(filename) as f:
+            complete = is_complete(f)
+        data = read_valid(filename, datasets, start=done, decode=decode)
+        if data['nValid'] > done:
+            yield data
+            done = data['nValid']
+        if complete:
+            return
+        time.sleep(poll)
@@ -0,0 +1,123 @@
+"""
+Learned rejection sampling: skip parameter sets that are predicted to fail QA
+
+Train a logistic regression on (norm_par, binQA) pairs from existing output
+files, then use it in run.py (--reject-model) to reject random draws that are
+unlikely to spike before simulating them. Each accepted draw is stored with
+an importance weight (sampleWeight dataset) so downstream users can reweight
+back to the original parameter distribution.
+
+Train with:
+$ python rejection.py --train runs/123/L5_TTPC1_cADpyr232_1/*.h5 --out L5_TTPC1_cADpyr.npz
+"""
+from __future__ import print_function
+
+import logging as log
+from argparse import ArgumentParser
+
+import numpy as np
+import h5py
+
+
+def load_training_data(filenames):
+    """
+    Read norm_par and binQA from each file. Rows that were never written
+    (all-zero norm_par) are dropped.
+    """
+    X, y = [], []
+    for fn in filenames:
+        with h5py.File(fn, 'r') as infile:
+            if 'norm_par' not in infile:
+                log.warning("{} has no norm_par (written with --blind?), skipping".format(fn))
+                continue
+            norm_par = infile['norm_par'][:]
+            qa = infile['binQA'][:]
+        written = np.any(norm_par != 0, axis=1)
+        X.append(norm_par[written])
+        y.append(qa[written] > 0)
+    if sum(len(x) for x in X) == 0:
+        raise ValueError("No written rows to train on in {} file(s)".format(len(filenames)))
+    return np.concatenate(X), np.concatenate(y)
+
+
+class RejectionModel(object):
+    """
+    Logistic regression predicting the probability that a normalized
+    parameter vector passes QA
+    """
+    def __init__(self, weights, bias, mean, std):
+        self.weights = np.asarray(weights)
+        self.bias = float(bias)
+        self.mean = np.asarray(mean)
+        self.std = np.asarray(std)
+
+    @classmethod
+    def train(cls, X, y, l2=1e-3, lr=0.5, n_iter=1000):
+        mean = X.mean(axis=0)
+        std = X.std(axis=0)
+        std[std == 0] = 1 # params that are not varied
+        Z = (X - mean) / std
+        y = y.astype(np.float64)
+
+        w, b = np.zeros(Z.shape[1]), 0.0
+        for _ in range(n_iter):
+            p = 1.0 / (1.0 + np.exp(-(Z.dot(w) + b)))
+            err = p - y
+            w -= lr * (Z.T.dot(err) / len(y) + l2 * w)
+            b -= lr * np.mean(err)
+
+        return cls(w, b, mean, std)
+
+    def predict_pass(self, X):
+        Z = (np.atleast_2d(X) - self.mean) / self.std
+        return 1.0 / (1.0 + np.exp(-(Z.dot(self.weights) + self.bias)))
+
+    def save(self, filename):
+        np.savez(filename, weights=self.weights, bias=self.bias, mean=self.mean, std=self.std)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['weights'], data['bias'], data['mean'], data['std'])
+
+
+def accept(model, norm_par, min_accept=0.05, rng=np.random):
+    """
+    Decide which draws to simulate. Each draw is accepted with probability
+    max(min_accept, P(pass)), so draws predicted to fail are down-weighted
+    rather than excluded outright.
+
+    Return the boolean acceptance mask, the importance weight of each draw
+    (1 / acceptance probability), and the predicted pass probabilities.
+    """
+    if not 0 < min_accept <= 1:
+        raise ValueError("min_accept must be in (0, 1], got {}".format(min_accept))
+    p_pass = model.predict_pass(norm_par)
+    p_accept = np.maximum(p_pass, min_accept)
+    accepted = rng.rand(len(p_accept)) < p_accept
+    return accepted, 1.0 / p_accept, p_pass
+
+
+def main(args):
+    X, y = load_training_data(args.train)
+    log.info("Training on {} samples, {:.1%} of which pass QA".format(len(y), np.mean(y)))
+    model = RejectionModel.train(X, y, l2=args.l2, n_iter=args.n_iter)
+    accuracy = np.mean((model.predict_pass(X) > 0.5) == y)
+    log.info("Training accuracy: {:.1%}".format(accuracy))
+    model.save(args.out)
+    log.info("Saved rejection model to {}".format(args.out))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--train', type=str, nargs='+', required=True,
+                        help='output files from run.py (all for the same cell) to train on')
+    parser.add_argument('--out', type=str, required=True, help='npz file to save the model to')
+    parser.add_argument('--l2', type=float, default=1e-3)
+    parser.add_argument('--n-iter', type=int, default=1000)
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
@@ -2,20 +2,24 @@ from __future__ import print_function
 
 import os
 import stat
+import errno
 import json
 import csv
 import itertools
+import warnings
 import logging as log
 from argparse import ArgumentParser
 from datetime import datetime
+from contextlib import contextmanager
 
 import numpy as np
-import matplotlib.pyplot as plt
 import h5py
-#import ruamel.yaml as yaml
-import yaml as yaml
-from stimulus import stims, add_stims
 import models
+import stimulus
+import readers
+import rejection
+import cell_catalog
+from qa_features import batch_qa, bin_qa, create_qa_datasets
 
 
 try:
@@ -30,7 +34,7 @@ except:
     rank = 0
     n_tasks = 1
     
-from neuron import h, gui
+from neuron import h
 
 VOLTS_SCALE = 150
 
@@ -49,21 +53,50 @@ def _rangeify_exponential(data, _range):
         data * (np.log(_range[1]) - np.log(_range[0])) + np.log(_range[0])
     )
 
-def get_model(model, log, m_type=None, e_type=None, cell_i=0, *params):
+def get_model(model, log, m_type=None, e_type=None, cell_i=0, *params, **kwargs):
+    """
+    kwargs (BBP only): probes (see models.select_probes()), nthread and multisplit (see BBP._setup_threads())
+    """
     if model != 'BBP':
         return MODELS_BY_NAME[model](*params, log=log)
     else:
         if m_type is None or e_type is None:
             raise ValueError('Must specify --m-type and --e-type when using BBP')
         
-        if e_type == 'cADpyr':
-            model = models.BBPExc(m_type, e_type, cell_i, *params, log=log)
-        else:
-            model = models.BBPInh(m_type, e_type, cell_i, *params, log=log)
-            
+        model = models.bbp_class(e_type)(m_type, e_type, cell_i, *params, log=log, **kwargs)
         model.create_cell()
         return model
 
+
+def get_model_meta(args):
+    """
+    A model to query for metadata only (param names/ranges/defaults, varied
+    params, probes). For BBP, this comes from the cell catalog when the cell
+    is in it, rather than building the cell (see cell_catalog.py). Built
+    once and kept on args, so every stage of a run shares it
+    """
+    key = (args.model, args.m_type, args.e_type, args.cell_i, tuple(args.probes or ()))
+    cached = getattr(args, '_meta_model', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    meta = None
+    if args.model == 'BBP' and args.catalog:
+        if args.m_type is None or args.e_type is None:
+            raise ValueError('Must specify --m-type and --e-type when using BBP')
+        meta = cell_catalog.lookup(args.m_type, args.e_type, args.cell_i, probes=args.probes,
+                                   filename=args.catalog)
+        if meta is None:
+            log.debug("{} {} {} not in catalog {}".format(args.m_type, args.e_type, args.cell_i, args.catalog))
+    if meta is None:
+        # Built like the simulated cells, so run_samples() can simulate with it
+        meta = get_model(args.model, log, args.m_type, args.e_type, args.cell_i, probes=args.probes,
+                         nthread=args.nthread, multisplit=args.multisplit)
+        if args.model == 'BBP':
+            meta.get_probe_names() # cache them before building the simulated cell deletes these sections
+    args._meta_model = (key, meta)
+    return meta
+
 def clean_params(args, model):
     """convert to float, use defaults where requested
 
@@ -91,7 +124,7 @@ def report_random_params(args, params, model):
 
     
 def get_random_params(args, n=1):
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
+    model = get_model_meta(args)
     ranges = model.PARAM_RANGES
     ndim = len(ranges)
     rand = np.random.rand(n, ndim)
@@ -120,6 +153,40 @@ def get_random_params(args, n=1):
     phys_rand[np.isnan(phys_rand)] = 9e9
     return phys_rand, rand
 
+
+def get_sampled_params(args, n=1):
+    """
+    get_random_params(), optionally followed by the learned rejection stage
+    (see rejection.py): draw until n parameter sets have been accepted.
+
+    Return phys params, unit params, and the importance weight of each
+    accepted draw (None without --reject-model)
+    """
+    if not args.reject_model:
+        phys, upar = get_random_params(args, n=n)
+        return phys, upar, None
+
+    reject_model = rejection.RejectionModel.load(args.reject_model)
+    phys_kept, upar_kept, weights_kept = [], [], []
+    n_accepted, n_drawn, expected_failures_avoided = 0, 0, 0.0
+    while n_accepted < n:
+        phys, upar = get_random_params(args, n=2*(n - n_accepted))
+        accepted, weights, p_pass = rejection.accept(reject_model, upar*2 - 1, min_accept=args.min_accept)
+        phys_kept.append(phys[accepted])
+        upar_kept.append(upar[accepted])
+        weights_kept.append(weights[accepted])
+        n_accepted += np.sum(accepted)
+        n_drawn += len(accepted)
+        expected_failures_avoided += np.sum(1 - p_pass[~accepted])
+
+    log.info("Rejection model accepted {} of {} draws ({:.1%}), saving {} simulations, "
+             "of which {:.1f} are expected to have failed QA".format(
+                 n_accepted, n_drawn, float(n_accepted)/n_drawn, n_drawn - n_accepted,
+                 expected_failures_avoided))
+
+    phys, upar, weights = [np.concatenate(x)[:n] for x in (phys_kept, upar_kept, weights_kept)]
+    return phys, upar, weights
+
         
 def get_mpi_idx(args, nsamples):
     if args.trivial_parallel:
@@ -140,16 +207,51 @@ def get_mpi_idx(args, nsamples):
     return start, stop
 
 
-def get_stim(args, mult=None):
-    stim_fn = os.path.basename(args.stim_file)
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
+def get_stim_multiplier(args, mult=None):
+    model = get_model_meta(args)
     multiplier = mult or args.stim_multiplier or model.STIM_MULTIPLIER
     log.debug("Stim multiplier = {}".format(multiplier))
-    return (np.genfromtxt(args.stim_file, dtype=np.float32) * multiplier) + args.stim_dc_offset
+    return multiplier
+
+
+def get_stim(args, mult=None):
+    """
+    The stimulus from --stim-file. With --stim-family, each sample has its
+    own stimulus (see get_sample_stim()), and this is the first one of this
+    rank. They all have the same length
+    """
+    if args.stim_family:
+        return get_sample_stim(args, stimulus.sample_seed(args.stim_seed, rank, 0), mult=mult)[0]
+    multiplier = get_stim_multiplier(args, mult)
+    return (stimulus.load_stim(args.stim_file, dt=args.dt) * multiplier) + args.stim_dc_offset
+
+
+def get_sample_stim(args, seed, mult=None):
+    """
+    Return (stimulus, generator params) for the sample with this seed, drawn from --stim-family
+    """
+    family = stimulus.get_family(args.stim_family, dt=args.dt)
+    params, stim = family.sample(seed)
+    stim = stim.astype(np.float32) * get_stim_multiplier(args, mult) + args.stim_dc_offset
+    return stim, params
+
+
+def get_rec_window(args, ntimepts):
+    """
+    The part of the simulation that is recorded and saved, from --tstart,
+    --tstop and --rec-dt: (first, stop, step) in units of timesteps
+    """
+    step = max(1, int(round(args.rec_dt / args.dt))) if args.rec_dt else 1
+    first = int(round(args.tstart / args.dt)) if args.tstart else 0
+    stop = min(int(round(args.tstop / args.dt)), ntimepts) if args.tstop else ntimepts
+    return first, stop, step
+
+
+def n_rec_timepts(args, ntimepts):
+    return len(range(*get_rec_window(args, ntimepts)))
 
 
 def _qa(args, trace, thresh=-10):
-    trace = trace[:-1] # My setup runs one extra timepoint. Too lazy to figure out why...
     if args.model == 'BBP':
         trace = trace[:, 0] # Take soma potential only
     thresh_crossings = np.diff((trace > thresh).astype('int'))
@@ -157,14 +259,60 @@ def _qa(args, trace, thresh=-10):
     return num_aps > 0
 
 
+# Values of the screenQA dataset
+SCREEN_PASSED = 0 # passed the prescreen, full simulation was run
+SCREEN_REJECTED = 1 # failed the prescreen, full simulation was skipped
+SCREEN_CALIBRATION = 2 # failed the prescreen, but full simulation was run anyway for calibration
+
+def prescreen(args, model, stim, saved_state=None):
+    """
+    Cheap, low-fidelity version of the simulation: record the soma only, use
+    a coarser dt, and only simulate a prefix of the stimulus. Return the
+    result of _qa() on that trace
+    """
+    stride = max(1, int(round(args.prescreen_dt / args.dt)))
+    npts = int(len(stim) * args.prescreen_frac)
+    coarse_stim = stim[:npts:stride]
+    data = model.simulate(coarse_stim, args.dt * stride, variables={'v'}, soma_only=True,
+                          prerun=args.prerun, saved_state=saved_state)
+    trace = np.stack(list(data.values()), axis=-1) if args.model == 'BBP' else data['v']
+    return _qa(args, trace[:-1]) # A full run records one extra timepoint
+
+
+def report_prescreen(args, screen_qa, qa):
+    """
+    Log how many full simulations the prescreen saved, and how many of the
+    calibration samples it would have wrongly rejected
+    """
+    counts = np.array([
+        np.sum(screen_qa == SCREEN_REJECTED),
+        min(len(screen_qa), args.prescreen_calibrate or 0), # the first --prescreen-calibrate samples of each rank
+        np.sum(screen_qa == SCREEN_CALIBRATION),
+        np.sum((screen_qa == SCREEN_CALIBRATION) & (qa > 0)),
+    ])
+    if comm and n_tasks > 1 and not args.trivial_parallel:
+        counts = comm.allreduce(counts)
+    saved, n_calib, calib_rejected, false_rejections = counts
+    log.info("Prescreen skipped {} full simulations".format(saved))
+    if args.prescreen_calibrate:
+        log.info("Prescreen calibration: {} of {} calibration samples would have been rejected, "
+                 "{} of them falsely (they pass QA at full fidelity)".format(
+                     calib_rejected, n_calib, false_rejections))
+
+
 def create_h5(args, nsamples):
     log.info("Creating h5 file {}".format(args.outfile))
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
-    with h5py.File(args.outfile, 'w') as f:
+    resolve_volts_dtype(args) # int16, unless save_h5() has already chosen from the data
+    model = get_model_meta(args)
+    with h5py.File(args.outfile, 'w', **({'libver': 'latest'} if args.swmr else {})) as f:
         # write params
         ndim = len(model.PARAM_NAMES)
-        f.create_dataset('phys_par', shape=(nsamples, ndim), dtype=np.float32)
-        f.create_dataset('norm_par', shape=(nsamples, ndim), dtype=np.float32)
+        def create_sample_dataset(name, shape, dtype, chunks=True):
+            # Per-sample datasets can grow along the first axis (see --append)
+            f.create_dataset(name, shape=(nsamples,) + shape, maxshape=(None,) + shape, chunks=chunks, dtype=dtype)
+
+        create_sample_dataset('phys_par', (ndim,), np.float32)
+        create_sample_dataset('norm_par', (ndim,), np.float32)
         f.create_dataset('varParL', data=np.string_(model.PARAM_NAMES))
         if args.model == 'BBP':
             f.create_dataset('probeName', data=np.string_(model.get_probe_names()))
@@ -181,18 +329,59 @@ def create_h5(args, nsamples):
 
         # create stim, qa, and voltage datasets
         stim = get_stim(args)
-        ntimepts = len(stim)
+        ntimepts = n_rec_timepts(args, len(stim))
+        sample_shape = (ntimepts, model._n_rec_pts()) if args.model == 'BBP' else (ntimepts,)
+        create_sample_dataset('voltages', sample_shape, VOLTS_DTYPES[args.volts_dtype], chunks=(1,) + sample_shape)
+        f['voltages'].attrs['quantization'] = args.quantize
+        if args.quantize == 'global':
+            f['voltages'].attrs['voltsScale'] = VOLTS_SCALE
+        elif args.quantize == 'probe':
+            f.create_dataset('voltsScale', shape=sample_shape[1:], dtype=np.float32)
+            f.create_dataset('voltsOffset', shape=sample_shape[1:], dtype=np.float32)
+        else:
+            create_sample_dataset('voltsScale', sample_shape[1:], np.float32)
+            create_sample_dataset('voltsOffset', sample_shape[1:], np.float32)
+        first, stop, step = get_rec_window(args, len(stim))
+        f['voltages'].attrs['tstart'] = first * args.dt
+        f['voltages'].attrs['dt'] = step * args.dt
+        if args.stim_family:
+            f.attrs['stimName'] = args.stim_family
+        else:
+            f.attrs['stimName'] = stimulus.stim_name(args.stim_file)
         if args.model == 'BBP':
-            f.create_dataset('voltages', shape=(nsamples, ntimepts, model._n_rec_pts()), dtype=np.int16)
+            f.attrs['bbpName'] = model.cell_kwargs['model_directory']
+        if args.prerun:
+            f['voltages'].attrs['prerun'] = args.prerun
+            f['voltages'].attrs['prerunMode'] = args.prerun_mode
+        create_sample_dataset('binQA', (), np.int32)
+        create_qa_datasets(f, nsamples, model._n_rec_pts() if args.model == 'BBP' else 1)
+        if args.early_stop:
+            create_sample_dataset('stopQA', (), np.int8)
+        if args.prescreen:
+            create_sample_dataset('screenQA', (), np.int8)
+        if args.reject_model:
+            create_sample_dataset('sampleWeight', (), np.float32)
+        if args.stim_family:
+            # Each sample's stimulus is regenerated from its seed and params (see stimulus.regenerate())
+            family = stimulus.get_family(args.stim_family, dt=args.dt)
+            create_sample_dataset('stimPar', (len(family.param_names),), np.float64)
+            create_sample_dataset('stimSeed', (), np.int64)
+            f.attrs['stimFamily'] = args.stim_family
+            f.attrs['stimParNames'] = np.string_(family.param_names)
+            f.attrs['stimSeedBase'] = args.stim_seed
+            f.attrs['stimDt'] = args.dt
+            f.attrs['stimMultiplier'] = get_stim_multiplier(args)
+            f.attrs['stimDcOffset'] = args.stim_dc_offset
         else:
-            f.create_dataset('voltages', shape=(nsamples, ntimepts), dtype=np.int16)
-        f.create_dataset('binQA', shape=(nsamples,), dtype=np.int32)
-        f.create_dataset('stim', data=stim)
+            f.create_dataset('stim', data=stim)
+        if args.swmr:
+            # Rows written so far, for readers of a file that is still being written (see readers.py)
+            f.create_dataset('nValid', shape=(1,), dtype=np.int64)
     log.info("Done.")
 
 
 def _normalize(args, data, minmax=1):
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
+    model = get_model_meta(args)
     nsamples = data.shape[0]
     mins = np.array([tup[0] for tup in model.PARAM_RANGES])
     mins = np.tile(mins, (nsamples, 1)) # stacked to same shape as input
@@ -202,32 +391,273 @@ def _normalize(args, data, minmax=1):
     return 2*minmax * ( (data - mins)/ranges ) - minmax
 
     
-def save_h5(args, buf, qa, params, start, stop, force_serial=False, upar=None):
+@contextmanager
+def _append_lock(args, parallel):
+    """
+    With --append, hold an exclusive lock on <outfile>.lock (on rank 0) from
+    reserving rows until they are written, so jobs appending to the same
+    file take turns
+    """
+    if parallel and rank != 0:
+        yield
+        return
+    import fcntl
+    with open(args.outfile + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _sample_datasets(f):
+    return [dset for dset in f.values()
+            if isinstance(dset, h5py.Dataset) and dset.maxshape and dset.maxshape[0] is None]
+
+
+def reserve_rows(args, my_n, sample_shape, parallel):
+    """
+    --append: extend every per-sample dataset of the output file (creating
+    it if needed) by the number of samples over all ranks, and return this
+    rank's [start, stop) among the new rows. Call inside _append_lock()
+    """
+    offset = (comm.exscan(my_n) or 0) if parallel else 0
+    total = comm.allreduce(my_n) if parallel else my_n
+
+    base, error = None, None
+    if rank == 0 or not parallel:
+        if not os.path.exists(args.outfile):
+            create_h5(args, 0)
+        with h5py.File(args.outfile, 'a') as f:
+            if f['voltages'].maxshape[0] is not None:
+                error = "{} was not created resizable, so it cannot be appended to".format(args.outfile)
+            elif f['voltages'].shape[1:] != sample_shape:
+                error = "Cannot append samples of shape {} to {} (samples of shape {})".format(
+                    sample_shape, args.outfile, f['voltages'].shape[1:])
+            else:
+                base = f['voltages'].shape[0]
+                for dset in _sample_datasets(f):
+                    dset.resize(base + total, axis=0)
+                f.attrs['complete'] = False # the new rows are empty until save_h5() has written them
+                log.info("Reserved rows {} to {} of {}".format(base, base + total, args.outfile))
+    if parallel:
+        base, error = comm.bcast((base, error), root=0)
+    if error:
+        raise ValueError(error)
+
+    return base + offset, base + offset + my_n
+
+
+def save_h5(args, buf, qa, params, start, stop, force_serial=False, upar=None, extra=None):
+    """
+    extra: optional dict of {dataset name: per-sample array} for the
+    optional QA datasets (eg stopQA, screenQA) created by create_h5()
+
+    With --append, the samples are written to new rows at the end of the
+    file instead of to [start, stop)
+    """
     log.info("saving into h5 file {}".format(args.outfile))
-    if (comm and n_tasks > 1) and not force_serial:
+    parallel = (comm and n_tasks > 1) and not force_serial
+    resolve_volts_dtype(args, buf, parallel)
+    if parallel:
         log.debug("using parallel")
         kwargs = {'driver': 'mpio', 'comm': comm}
     else:
         log.debug("using serial")
         kwargs = {}
 
+    if args.append:
+        with _append_lock(args, parallel):
+            start, stop = reserve_rows(args, stop - start, buf.shape[1:], parallel)
+            _write_h5(args, kwargs, buf, qa, params, start, stop, upar, extra, volts_quantization(args, buf))
+            if parallel:
+                comm.Barrier() # everyone has written before rank 0 lets the next job in
+            if rank == 0 or not parallel:
+                # Every reserved row is written: earlier jobs wrote theirs before releasing the lock
+                with h5py.File(args.outfile, 'a') as f:
+                    f.attrs['complete'] = True
+        return # leave the file writable for the next job
+
     if not os.path.exists(args.outfile):
         create_h5(args, stop-start)
-    
+
+    _write_h5(args, kwargs, buf, qa, params, start, stop, upar, extra, volts_quantization(args, buf, parallel))
+    os.chmod(args.outfile, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+VOLTS_DTYPES = {'int16': np.int16, 'int8': np.int8}
+
+
+def volts_quantization(args, buf, parallel=False):
+    """
+    Return the (scale, offset) to encode buf with, for --quantize:
+      global: the fixed VOLTS_SCALE and no offset
+      probe: per probe, over every sample (and every rank, if parallel)
+      sample: per sample and probe, shaped like buf without its time axis
+    Each range is mapped onto the whole range of --volts-dtype
+    """
+    if args.quantize == 'global':
+        return np.float32(VOLTS_SCALE), np.float32(0)
+
+    axis = 1 if args.quantize == 'sample' else (0, 1)
+    if args.quantize == 'probe' and len(buf) == 0:
+        lo, hi = np.full(buf.shape[2:], np.inf), np.full(buf.shape[2:], -np.inf)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # all-nan traces
+            lo, hi = np.nanmin(buf, axis=axis), np.nanmax(buf, axis=axis)
+    lo, hi = np.array(lo, dtype=np.float64), np.array(hi, dtype=np.float64)
+    if args.quantize == 'probe' and parallel:
+        comm.Allreduce(MPI.IN_PLACE, lo, op=MPI.MIN)
+        comm.Allreduce(MPI.IN_PLACE, hi, op=MPI.MAX)
+    lo[~np.isfinite(lo)] = 0
+    hi[~np.isfinite(hi)] = 0
+
+    half_range = (hi - lo) / 2.0
+    qmax = np.iinfo(VOLTS_DTYPES[args.volts_dtype]).max
+    scale = np.where(half_range > 0, qmax / np.maximum(half_range, 1e-12), 1.0).astype(np.float32)
+    offset = ((hi + lo) / 2.0).astype(np.float32)
+    log.debug("Voltage resolution: worst {} mV".format(np.max(1.0 / scale)))
+    return scale, offset
+
+
+def resolve_volts_dtype(args, buf=None, parallel=False):
+    """
+    --volts-dtype auto: use int8 if, with the per-probe or per-sample ranges
+    of buf (see volts_quantization()), every voltage would still be stored to
+    within --volts-tolerance mV, and int16 otherwise. An existing output
+    file keeps its dtype, and without buf (the file is created before
+    anything is simulated) or with --quantize global it is int16
+    """
+    if args.volts_dtype != 'auto':
+        return
+    exists = bool(args.outfile) and os.path.exists(args.outfile)
+    if parallel:
+        exists = comm.bcast(exists, root=0) # every rank takes the same branch (and collectives) below
+    if exists:
+        with h5py.File(args.outfile, 'r') as f:
+            args.volts_dtype = np.dtype(f['voltages'].dtype).name
+    elif buf is None or args.quantize == 'global':
+        args.volts_dtype = 'int16'
+    else:
+        args.volts_dtype = 'int8'
+        scale, _ = volts_quantization(args, buf, parallel)
+        worst = np.array(np.max(1.0 / scale) if scale.size else 0.0)
+        if parallel and args.quantize == 'sample':
+            comm.Allreduce(MPI.IN_PLACE, worst, op=MPI.MAX)
+        if worst > args.volts_tolerance:
+            args.volts_dtype = 'int16'
+        log.info("--volts-dtype auto: {} (int8 resolution would be {:.3f} mV)".format(args.volts_dtype, float(worst)))
+
+
+def _encode_volts(args, buf, scale, offset):
+    """
+    Quantize buf with (scale, offset) from volts_quantization(). Decode with readers.decode_volts().
+    Global quantization truncates, as files written before --quantize did; the others round
+    """
+    if args.quantize == 'sample':
+        scale, offset = np.expand_dims(scale, 1), np.expand_dims(offset, 1) # broadcast over time
+    qmax = np.iinfo(VOLTS_DTYPES[args.volts_dtype]).max
+    q = (buf - offset) * scale
+    if args.quantize != 'global':
+        q = np.round(q)
+    q = np.nan_to_num(q)
+    n_clipped = np.count_nonzero(np.abs(q) > qmax)
+    if n_clipped:
+        log.warning("{} voltages are outside the range of {} and were clipped".format(n_clipped, args.volts_dtype))
+    return q.clip(-qmax, qmax).astype(VOLTS_DTYPES[args.volts_dtype])
+
+
+def _write_quantization(args, f, start, stop, scale, offset):
+    if args.quantize == 'sample':
+        f['voltsScale'][start:stop, ...] = scale
+        f['voltsOffset'][start:stop, ...] = offset
+    elif args.quantize == 'probe':
+        f['voltsScale'][...] = scale
+        f['voltsOffset'][...] = offset
+
+
+class SwmrWriter(object):
+    """
+    --swmr: write each sample's voltage and binQA to the output file as soon
+    as it is simulated, in HDF5 single-writer/multiple-reader mode, so the
+    file can be read while the run goes on (see readers.py). Every
+    flush_every samples the data is flushed, then nValid is advanced, so
+    readers never see a row counted before its data
+    """
+    def __init__(self, args, start, stop, params, upar=None, flush_every=10):
+        if not os.path.exists(args.outfile):
+            create_h5(args, stop - start)
+        resolve_volts_dtype(args) # the file's dtype
+        self.args = args
+        self.start, self.stop = start, stop
+        self.flush_every = flush_every
+        self.n_written = 0
+        self.f = h5py.File(args.outfile, 'r+', libver='latest')
+        if 'nValid' not in self.f:
+            raise ValueError("{} was not created with --swmr".format(args.outfile))
+        if not args.blind:
+            self.f['phys_par'][start:stop, :] = params
+            self.f['norm_par'][start:stop, :] = (upar*2 - 1) if upar is not None else _normalize(args, params)
+        self.f.swmr_mode = True # no new datasets or attributes from here on
+        log.info("Writing {} in SWMR mode".format(args.outfile))
+
+    def write_sample(self, i, v, qa):
+        row = self.start + i
+        scale, offset = volts_quantization(self.args, v[np.newaxis])
+        self.f['voltages'][row, ...] = _encode_volts(self.args, v[np.newaxis], scale, offset)[0]
+        _write_quantization(self.args, self.f, row, row + 1, scale, offset)
+        self.f['binQA'][row] = qa
+        self.n_written = i + 1
+        if self.n_written % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for name in ('voltages', 'voltsScale', 'voltsOffset', 'binQA', 'phys_par', 'norm_par'):
+            if name in self.f:
+                self.f[name].flush()
+        self.f['nValid'][0] = self.start + self.n_written
+        self.f['nValid'].flush()
+
+    def finish(self, extra=None, qa=None):
+        """
+        Write the per-sample datasets that are only known at the end (and
+        binQA as computed by batch_qa()), then mark every row valid
+        """
+        if qa is not None:
+            self.f['binQA'][self.start:self.stop] = qa
+        for name, data in (extra or {}).items():
+            self.f[name][self.start:self.stop] = data
+            self.f[name].flush()
+        self.n_written = self.stop - self.start
+        self.flush()
+        self.f.close()
+        log.info("closed h5")
+
+
+def _write_h5(args, kwargs, buf, qa, params, start, stop, upar, extra, quantization):
     with h5py.File(args.outfile, 'a', **kwargs) as f:
         log.debug("opened h5")
         log.debug(str(params))
-        f['voltages'][start:stop, ...] = (buf*VOLTS_SCALE).clip(-32767,32767).astype(np.int16)
+        f['voltages'][start:stop, ...] = _encode_volts(args, buf, *quantization)
+        _write_quantization(args, f, start, stop, *quantization)
         f['binQA'][start:stop] = qa
+        for name, data in (extra or {}).items():
+            f[name][start:stop] = data
         if not args.blind:
             f['phys_par'][start:stop, :] = params
             f['norm_par'][start:stop, :] = (upar*2 - 1) if upar is not None else _normalize(args, params)
+        if not args.append:
+            f.attrs['complete'] = True # all samples written (see campaign.py); save_h5() does this for --append
         log.info("saved h5")
     log.info("closed h5")
-    os.chmod(args.outfile, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
 
-def write_metadata(args, model):
+def write_metadata(args, model, exclusive=False):
+    """
+    With exclusive, only write the file if it does not exist yet, so of
+    several ranks running the same cell only the first writes it
+    """
     log.info("writing metadata")
     if args.model != 'BBP' or not args.metadata_file:
         return
@@ -245,9 +675,11 @@ def write_metadata(args, model):
     path, fn = os.path.split(args.outfile)
     bbp_name = model.cell_kwargs['model_directory']
     stimname = os.environ.get('stimname')
+    # Rounded to whole timesteps, as in the voltages attrs
+    first, _, step = get_rec_window(args, len(get_stim(args)))
     metadata = {
-        'timeAxis': {'step': args.dt, 'unit': "(ms)"},
-        'voltsScale': VOLTS_SCALE,
+        'timeAxis': {'step': step * args.dt, 'start': first * args.dt, 'unit': "(ms)"},
+        'quantization': args.quantize,
         'varParL': params,
         'probeName': model.get_probe_names(),
         'bbpName': bbp_name,
@@ -255,6 +687,13 @@ def write_metadata(args, model):
         'rawDataName': '{}-{}-*.h5'.format(bbp_name, stimname), # HACK
         'stimName': stimname, # HACK
     }
+    if args.quantize == 'global':
+        metadata['voltsScale'] = VOLTS_SCALE
+        metadata['voltsOffset'] = 0
+    else:
+        # The scale and offset vary per probe or per sample; decode with readers.decode_volts()
+        metadata['voltsScaleDataset'] = 'voltsScale'
+        metadata['voltsOffsetDataset'] = 'voltsOffset'
 
     def serialize(val):
         if isinstance(val, list):
@@ -265,35 +704,57 @@ def write_metadata(args, model):
             return '{' + body + '}'
         return val
 
-    with open(args.metadata_file, 'w') as outfile:
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+    try:
+        fd = os.open(args.metadata_file, flags, 0o644)
+    except OSError as e:
+        if exclusive and e.errno == errno.EEXIST:
+            log.info("{} was written by another rank".format(args.metadata_file))
+            return
+        raise
+    with os.fdopen(fd, 'w') as outfile:
         for k,v in metadata.items():
             print('{}: {}'.format(k, serialize(v)), file=outfile)
     log.info("wrote metadata")
         
 
+def required_variables(args):
+    """
+    The variables that must be recorded: the voltage (the only thing saved
+    to disk) plus whatever was requested with --plot. None means everything
+    """
+    if args.plot == []:
+        return None
+    return {'v'} | set(args.plot or [])
+
+
 def plot(args, data, stim):
     if args.plot is not None:
-        ntimepts = len(stim)
-        t_axis = np.linspace(0, ntimepts*h.dt, ntimepts)
+        import matplotlib.pyplot as plt # only when plotting, so headless ranks never load it
+
+        first, stop, step = get_rec_window(args, len(stim))
+        ntimepts = len(range(first, stop, step))
+        t_axis = (first + step * np.arange(ntimepts)) * h.dt
+        stim = stim[first:stop:step]
 
         plt.figure(figsize=(10, 5))
         plt.xlabel('Time (ms)')
 
         if args.plot == [] or 'v' in args.plot:
             plt.plot(t_axis, data['v'][:ntimepts], label='V_m')
-        if args.plot == [] or 'v_dend' in args.plot:
+        if (args.plot == [] or 'v_dend' in args.plot) and 'v_dend' in data:
             plt.plot(t_axis, data['v_dend'][:ntimepts], label='v_dend')
         if args.plot == [] or 'stim' in args.plot:
             plt.plot(t_axis, stim[:ntimepts], label='stim')
-        if args.plot == [] or 'ina' in args.plot:
+        if (args.plot == [] or 'ina' in args.plot) and 'ina' in data:
             plt.plot(t_axis, data['ina'][:ntimepts] * 100, label='i_na*100')
-        if args.plot == [] or 'ik' in args.plot:
+        if (args.plot == [] or 'ik' in args.plot) and 'ik' in data:
             plt.plot(t_axis, data['ik'][:ntimepts] * 100, label='i_k*100')
-        if args.plot == [] or 'ica' in args.plot:
+        if (args.plot == [] or 'ica' in args.plot) and 'ica' in data:
             plt.plot(t_axis, data['ica'][:ntimepts] * 100, label='i_ca*100')
-        if args.plot == [] or 'i_cap' in args.plot:
+        if (args.plot == [] or 'i_cap' in args.plot) and 'i_cap' in data:
             plt.plot(t_axis, data['i_cap'][:ntimepts] * 100, label='i_cap*100')
-        if args.plot == [] or 'i_leak' in args.plot:
+        if (args.plot == [] or 'i_leak' in args.plot) and 'i_leak' in data:
             plt.plot(t_axis, data['i_leak'][:ntimepts] * 100, label='i_leak*100')
 
         if not args.no_legend:
@@ -302,7 +763,11 @@ def plot(args, data, stim):
         plt.show()
 
 
-def add_qa(args):
+def add_qa(args, chunk_size=1000):
+    """
+    (Re)compute binQA and the batch_qa() features for an existing file,
+    decoding the stored voltages a block of samples at a time
+    """
     log.debug("adding qa")
     if comm and n_tasks > 1:
         log.debug("using parallel")
@@ -310,22 +775,26 @@ def add_qa(args):
     else:
         log.debug("using serial")
         kwargs = {}
-        
-    start, stop = get_mpi_idx(args, args.num)
-        
-    with h5py.File(args.outfile, 'r', **kwargs) as f:
-        v = f['voltages'][start:stop, :]
-
-    qa = np.zeros(stop-start)
-
-    for i in range(start, stop):
-        if args.print_every and i % args.print_every == 0:
-            log.info("done {}".format(i))
-        qa[i] = _qa(v[i, :])
 
     with h5py.File(args.outfile, 'a', **kwargs) as f:
-        f.create_dataset('qa', shape=(args.num,))
-        f['qa'][start:stop] = qa
+        nsamples = f['voltages'].shape[0]
+        nprobes = f['voltages'].shape[2] if f['voltages'].ndim == 3 else 1
+        create_qa_datasets(f, nsamples, nprobes)
+
+        start, stop = get_mpi_idx(args, args.num or nsamples)
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            if args.print_every:
+                log.info("done {}".format(chunk_start - start))
+            v = readers.decode_volts(f, chunk_start, chunk_stop)
+            volts_scale = VOLTS_SCALE if readers.quantization(f) == 'global' else None # only global clips
+            stop_reason = f['stopQA'][chunk_start:chunk_stop] if 'stopQA' in f else None
+            features = batch_qa(v, f['voltages'].attrs.get('dt', args.dt), volts_scale=volts_scale,
+                                tstart=f['voltages'].attrs.get('tstart', 0), stop_reason=stop_reason)
+            for name, data in features.items():
+                f[name][chunk_start:chunk_stop, ...] = data
+            # Early-stopped samples stay rejected, as when they were simulated
+            f['binQA'][chunk_start:chunk_stop] = bin_qa(features['qaMask'])
 
     log.debug("done")
 
@@ -334,7 +803,7 @@ def lock_params(args, paramsets):
     # DEPRECATED. Create/use Latched model sublcasses (see HHBallStick7ParamLatched)
     assert len(args.locked_params) % 2 == 0
 
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
+    model = get_model_meta(args)
     paramnames = model.PARAM_NAMES
     nsets = len(args.locked_params)//2
     
@@ -347,6 +816,294 @@ def lock_params(args, paramsets):
         paramsets[:, target_i] = paramsets[:, source_i]
 
 
+def run_samples(args, paramsets, stim, model, n_done=0, writer=None):
+    """
+    Simulate each parameter set in paramsets.
+
+    Return the voltage buffer, the QA results, and a dict of the optional
+    per-sample QA datasets (see save_h5()). n_done is the number of samples
+    this rank has already simulated in previous calls. If given, the
+    SwmrWriter writer is passed each sample as soon as it is done
+    """
+    nsamples = len(paramsets)
+    rec_window = get_rec_window(args, len(stim))
+    nrec = len(range(*rec_window))
+    rec_dt = rec_window[2] * args.dt
+    rec_tstart = rec_window[0] * args.dt
+    if rec_window == (0, len(stim), 1):
+        rec_window = None # record everything
+    if args.model == 'BBP':
+        buf = np.zeros(shape=(nsamples, nrec, model._n_rec_pts()), dtype=np.float32)
+    else:
+        buf = np.zeros(shape=(nsamples, nrec), dtype=np.float32)
+    qa = np.zeros(nsamples)
+    extra = {}
+    if args.early_stop:
+        extra['stopQA'] = np.zeros(nsamples, dtype=np.int8)
+    if args.prescreen:
+        extra['screenQA'] = np.zeros(nsamples, dtype=np.int8)
+    if args.stim_family:
+        n_stim_par = len(stimulus.get_family(args.stim_family).param_names)
+        extra['stimPar'] = np.zeros((nsamples, n_stim_par), dtype=np.float64)
+        extra['stimSeed'] = np.zeros(nsamples, dtype=np.int64)
+    monitor = models.SimMonitor(check_every=args.early_stop_check_ms, block_ms=args.block_ms) \
+              if args.early_stop else None
+    variables = required_variables(args)
+
+    sim_model = None
+    if args.model == 'BBP' and isinstance(get_model_meta(args), models.BBP):
+        # The cell the setup stages built (ie not a catalog entry) is reused, see BBP.set_params()
+        sim_model = get_model_meta(args)
+    default_state = None
+    if args.prerun and args.prerun_mode == 'default':
+        # One steady state for all samples, computed at the default params
+        if sim_model is None:
+            sim_model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i, probes=args.probes,
+                                  nthread=args.nthread, multisplit=args.multisplit)
+        elif args.model == 'BBP':
+            sim_model.set_params() # back to the defaults (rebuilds the cell)
+        default_state = sim_model.steady_state(args.prerun, args.dt)
+
+    for i, params in enumerate(paramsets):
+        if args.print_every and (n_done + i) % args.print_every == 0:
+            log.info("Processed {} samples".format(n_done + i))
+        log.debug("About to run with params = {}".format(params))
+
+        if args.model == 'BBP' and sim_model is not None:
+            sim_model.set_params(*params) # reuse the cell, see BBP.set_params()
+        else:
+            sim_model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i, *params,
+                                  probes=args.probes, nthread=args.nthread, multisplit=args.multisplit)
+        model = sim_model
+
+        if args.stim_family:
+            seed = stimulus.sample_seed(args.stim_seed, rank, n_done + i)
+            stim, extra['stimPar'][i] = get_sample_stim(args, seed)
+            extra['stimSeed'][i] = seed
+
+        if args.prescreen and not prescreen(args, model, stim, saved_state=default_state):
+            if n_done + i < args.prescreen_calibrate:
+                extra['screenQA'][i] = SCREEN_CALIBRATION
+            else:
+                extra['screenQA'][i] = SCREEN_REJECTED
+                if writer:
+                    writer.write_sample(i, buf[i], qa[i])
+                continue
+
+        # Traces are written straight into buf[i]
+        data = model.simulate(stim, args.dt, monitor=monitor, variables=variables, rec_window=rec_window,
+                              out=buf[i], prerun=args.prerun, saved_state=default_state)
+        if args.model == 'BBP':
+            data['v'] = buf[i]
+        if args.early_stop:
+            extra['stopQA'][i] = model.stop_reason
+        if writer:
+            # The reader sees binQA before batch_qa() runs on the whole block
+            qa[i] = _qa(args, buf[i]) and model.stop_reason == models.STOP_NONE
+            writer.write_sample(i, buf[i], qa[i])
+
+        plot(args, data, stim)
+
+    extra.update(batch_qa(buf, rec_dt, volts_scale=VOLTS_SCALE if args.quantize == 'global' else None,
+                          tstart=rec_tstart, stop_reason=extra.get('stopQA')))
+    qa[:] = bin_qa(extra['qaMask'])
+
+    return buf, qa, extra
+
+
+def run_until_target(args, stim, model):
+    """
+    Draw and simulate random parameter sets in batches of --target-batch
+    until --target-pass samples have passed QA (over all ranks, unless
+    using --trivial-parallel) or --max-attempts samples have been
+    simulated. Only the samples that pass QA are kept, trimmed so the
+    total is exactly --target-pass.
+
+    Returns buf, qa, paramsets, upar, extra, start, stop like the other
+    branches of main(), where [start, stop) is this rank's slice of the
+    output file. The output file is (re)created here at the final size.
+    """
+    parallel = comm is not None and n_tasks > 1 and not args.trivial_parallel
+    max_attempts = args.max_attempts or 10 * args.target_pass
+
+    kept = {'buf': [], 'qa': [], 'phys': [], 'upar': []}
+    kept_extra = {}
+    all_screen_qa, all_qa = [], []
+    n_done, n_passed, n_attempts = 0, 0, 0
+    while n_passed < args.target_pass and n_attempts < max_attempts:
+        paramsets, upar, weights = get_sampled_params(args, n=args.target_batch)
+        lock_params(args, paramsets)
+        buf, qa, extra = run_samples(args, paramsets, stim, model, n_done=n_done)
+        if weights is not None:
+            extra['sampleWeight'] = weights
+        n_done += len(paramsets)
+        if args.prescreen:
+            all_screen_qa.append(extra['screenQA'])
+            all_qa.append(qa)
+
+        passed = qa > 0
+        kept['buf'].append(buf[passed])
+        kept['qa'].append(qa[passed])
+        kept['phys'].append(paramsets[passed])
+        kept['upar'].append(upar[passed])
+        for name, data in extra.items():
+            kept_extra.setdefault(name, []).append(data[passed])
+
+        counts = np.array([np.sum(passed), len(paramsets)])
+        if parallel:
+            counts = comm.allreduce(counts)
+        n_passed += counts[0]
+        n_attempts += counts[1]
+        log.debug("{} of {} attempts have passed QA so far".format(n_passed, n_attempts))
+
+    if n_passed < args.target_pass:
+        log.warning("Only {} of {} requested samples passed QA after {} attempts".format(
+            n_passed, args.target_pass, n_attempts))
+    else:
+        log.info("{} samples passed QA after {} attempts".format(n_passed, n_attempts))
+
+    if args.prescreen:
+        report_prescreen(args, np.concatenate(all_screen_qa), np.concatenate(all_qa))
+
+    buf, qa, paramsets, upar = [np.concatenate(kept[k]) for k in ('buf', 'qa', 'phys', 'upar')]
+    extra = {name: np.concatenate(data) for name, data in kept_extra.items()}
+
+    # Trim so the total over all ranks is exactly the target
+    my_n = len(qa)
+    offset = (comm.exscan(my_n) or 0) if parallel else 0
+    total = min(n_passed, args.target_pass)
+    my_n = max(0, min(my_n, total - offset))
+    buf, qa, paramsets, upar = buf[:my_n], qa[:my_n], paramsets[:my_n], upar[:my_n]
+    extra = {name: data[:my_n] for name, data in extra.items()}
+
+    if args.outfile and not args.append: # with --append, rows are added when saving
+        if not parallel:
+            create_h5(args, total)
+        else:
+            if rank == 0:
+                create_h5(args, total)
+            comm.Barrier()
+
+    return buf, qa, paramsets, upar, extra, offset, offset + my_n
+
+
+def set_production_params(args):
+    """
+    Hold some params fixed, as in the production runs
+    """
+    if args.params:
+        log.warning("Replacing --params with the production params for {}".format(args.e_type))
+    paramuse = [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 0, 0, 1, 1, 1, 1] \
+               if args.e_type == 'cADpyr' else [1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 1, 1]
+    args.params = [('inf' if use else 'def') for use in paramuse]
+
+    if args.e_type in ('bIR', 'bAC'):
+        paramuse[20] = 0
+        log.info('Not varying negative parameters for e-type {}'.format(args.e_type))
+
+
+def apply_work_unit(args, unit):
+    """
+    Set the cell (and optionally the sample count, stimulus and output
+    file) for this rank from an entry of a --schedule or --manifest.
+    Return the cell's bbp name
+    """
+    args.m_type, args.e_type, args.cell_i = unit['m_type'], unit['e_type'], unit['cell_i']
+    for key in ('num', 'target_pass', 'stim_file', 'outfile'):
+        if key in unit:
+            setattr(args, key, unit[key])
+    log.info("from rank {} running cell {} ({} samples)".format(
+        rank, unit['bbp_name'], unit.get('num') or unit.get('target_pass')))
+    set_production_params(args)
+    return unit['bbp_name']
+
+
+def run_manifest(args):
+    """
+    Run this rank's share of the work units in a manifest from campaign.py,
+    one after another (each unit is written to its own file)
+    """
+    import copy
+
+    with open(args.manifest) as infile:
+        units = json.load(infile)['units']
+    procid = int(os.environ.get('SLURM_PROCID', rank))
+    ntasks = int(os.environ.get('SLURM_NTASKS', n_tasks))
+    for unit in units[procid::ntasks]:
+        outdir = os.path.dirname(unit['outfile'])
+        if outdir and not os.path.exists(outdir):
+            try:
+                os.makedirs(outdir)
+            except OSError:
+                pass # made by another rank
+        unit_args = copy.copy(args)
+        unit_args.work_unit = unit
+        unit_args.trivial_parallel = True
+        main(unit_args)
+
+
+def _is_complete(filename):
+    """
+    Whether every row of an existing output file is written. Files from before
+    the complete attribute count as complete if every row has params (as in
+    campaign.scan_file())
+    """
+    with readers.open_file(filename) as f:
+        if readers.is_complete(f):
+            return True
+        if 'complete' in f.attrs or 'nValid' in f or 'norm_par' not in f:
+            return False
+        return bool(np.all(np.any(f['norm_par'][:] != 0, axis=1)))
+
+
+def run_pipeline_stages(args):
+    """
+    --pipeline: do the setup stages of a run in the same launch as the
+    simulation, sharing the model between them (see get_model_meta()):
+    create the param file, create the output file and write the metadata.
+    Each stage is skipped if its output already exists, and rank 0 does
+    each while the other ranks wait.
+
+    Return False if the simulation itself is already done
+    """
+    parallel = comm is not None and n_tasks > 1 and not args.trivial_parallel
+
+    def on_rank_0(stage):
+        if rank == 0 or not parallel:
+            stage()
+        if parallel:
+            comm.Barrier()
+
+    if args.param_file and not os.path.exists(args.param_file):
+        if not args.num:
+            raise ValueError("Must pass --num to create the param file")
+        log.info("pipeline: creating params")
+        on_rank_0(lambda: np.savetxt(args.param_file, get_random_params(args, n=args.num)[0]))
+
+    if args.metadata_file and not os.path.exists(args.metadata_file):
+        log.info("pipeline: writing metadata")
+        # With --trivial-parallel every rank is on its own, so the first rank of each cell writes it
+        on_rank_0(lambda: write_metadata(args, get_model_meta(args), exclusive=not parallel))
+
+    if args.append:
+        pass # save_h5() adds rows to the file, creating it if needed
+    elif args.outfile and os.path.exists(args.outfile):
+        done = _is_complete(args.outfile) if rank == 0 or not parallel else None
+        if parallel:
+            done = comm.bcast(done, root=0)
+        if done:
+            log.info("pipeline: {} is already complete".format(args.outfile))
+            return False
+    elif args.outfile and parallel and not args.target_pass:
+        # With --trivial-parallel, each rank creates its own file when saving.
+        # With --target-pass, the file is created once the final count is known
+        nsamples = len(np.genfromtxt(args.param_file, dtype=np.float32)) if args.param_file else args.num
+        log.info("pipeline: creating {}".format(args.outfile))
+        on_rank_0(lambda: create_h5(args, nsamples))
+
+    return True
+
+
 def main(args):
     if args.trivial_parallel and args.outfile and '{NODEID}' in args.outfile:
         args.outfile = args.outfile.replace('{NODEID}', os.environ['SLURM_PROCID'])
@@ -370,19 +1127,34 @@ def main(args):
                     log.info("from rank {} running cell {}".format(rank, bbp_name))
                     break
 
-        # Get param string for holding some params fixed
-        paramuse = [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 0, 0, 1, 1, 1, 1] \
-                   if args.e_type == 'cADpyr' else [1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 1, 1]
-        args.params = [('inf' if use else 'def') for use in paramuse]
+        set_production_params(args)
+
+    if args.schedule:
+        if not args.trivial_parallel:
+            raise ValueError("--schedule gives each rank its own cell, so it needs --trivial-parallel")
+        with open(args.schedule) as infile:
+            schedule = json.load(infile)
+        entry = schedule['ranks'].get(os.environ.get('SLURM_PROCID', str(rank)))
+        if entry is None:
+            log.debug("No work for rank {} in the schedule".format(rank))
+            return
+        bbp_name = apply_work_unit(args, entry)
 
-        if args.e_type in ('bIR', 'bAC'):
-            paramuse[20] = 0
-            log.info('Not varying negative parameters for e-type {}'.format(args.e_type))
+    if args.work_unit:
+        bbp_name = apply_work_unit(args, args.work_unit)
 
     if args.outfile and '{BBP_NAME}' in args.outfile:
         args.outfile = args.outfile.replace('{BBP_NAME}', bbp_name)
         args.metadata_file = args.metadata_file.replace('{BBP_NAME}', bbp_name)
 
+    if args.stim_family and args.stim_seed is None:
+        args.stim_seed = np.random.randint(2**31)
+        if comm and n_tasks > 1 and not args.trivial_parallel:
+            args.stim_seed = comm.bcast(args.stim_seed, root=0)
+
+    if args.pipeline and not run_pipeline_stages(args):
+        return
+
     if args.create:
         if not args.num:
             raise ValueError("Must pass --num when creating h5 file")
@@ -400,12 +1172,27 @@ def main(args):
     if args.blind and not args.param_file:
         raise ValueError("Must pass --param-file with --blind")
 
-    model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i)
+    if args.reject_model and not 0 < args.min_accept <= 1:
+        raise ValueError("--min-accept must be in (0, 1]: draws that are never accepted " + \
+                         "would get infinite weight")
+
+    if args.quantize == 'global' and args.volts_dtype not in ('int16', 'auto'):
+        raise ValueError("--quantize global needs --volts-dtype int16")
+    if args.quantize == 'probe' and (args.append or args.swmr):
+        raise ValueError("--quantize probe needs every sample up front. Use --quantize sample " + \
+                         "with --append or --swmr")
+
+    if args.swmr and ((comm and n_tasks > 1 and not args.trivial_parallel) or args.append or args.target_pass):
+        raise ValueError("--swmr needs a single writer per file (use --trivial-parallel), " + \
+                         "and does not work with --append or --target-pass")
+
+    model = get_model_meta(args)
 
     if args.metadata_only:
         write_metadata(args, model)
         exit()
-    
+
+    weights = None # importance weights from --reject-model
     if args.param_file:
         all_paramsets = np.genfromtxt(args.param_file, dtype=np.float32)
         upar = None # TODO: save or generate unnormalized params when using --param-file
@@ -413,9 +1200,12 @@ def main(args):
         if args.num and start > args.num:
             return
         paramsets = all_paramsets[start:stop, :]
+    elif args.target_pass:
+        # Parameter sets are drawn in batches by run_until_target()
+        paramsets, upar, start, stop = None, None, None, None
     elif args.num:
         start, stop = get_mpi_idx(args, args.num)
-        paramsets, upar = get_random_params(args, n=stop-start)
+        paramsets, upar, weights = get_sampled_params(args, n=stop-start)
     elif args.params not in (None, [None]):
         paramsets = np.atleast_2d(np.array(args.params))
         upar = None
@@ -426,32 +1216,27 @@ def main(args):
         upar = None
         start, stop = 0, 1
 
-    lock_params(args, paramsets)
-
     stim = get_stim(args)
-    if args.model == 'BBP':
-        buf = np.zeros(shape=(stop-start, len(stim), model._n_rec_pts()), dtype=np.float32)
-    else:
-        buf = np.zeros(shape=(stop-start, len(stim)), dtype=np.float32)
-    qa = np.zeros(stop-start)
-
-    for i, params in enumerate(paramsets):
-        if args.print_every and i % args.print_every == 0:
-            log.info("Processed {} samples".format(i))
-        log.debug("About to run with params = {}".format(params))
-
-        model = get_model(args.model, log, args.m_type, args.e_type, args.cell_i, *params)
-        data = model.simulate(stim, args.dt)
-        if args.model == 'BBP':
-            data['v'] = np.stack(list(data.values()), axis=-1)
-        buf[i, ...] = data['v'][:-1]
-        qa[i] = _qa(args, data['v'])
 
-        plot(args, data, stim)
+    if args.target_pass:
+        buf, qa, paramsets, upar, extra, start, stop = run_until_target(args, stim, model)
+    else:
+        lock_params(args, paramsets)
+        writer = SwmrWriter(args, start, stop, paramsets, upar, flush_every=args.swmr_flush_every) \
+                 if args.swmr and args.outfile else None
+        buf, qa, extra = run_samples(args, paramsets, stim, model, writer=writer)
+        if weights is not None:
+            extra['sampleWeight'] = weights
+        if args.prescreen:
+            report_prescreen(args, extra['screenQA'], qa)
+        if writer:
+            writer.finish(extra, qa)
+            return
         
     # Save to disk
     if args.outfile:
-        save_h5(args, buf, qa, paramsets, start, stop, force_serial=args.trivial_parallel, upar=upar)
+        save_h5(args, buf, qa, paramsets, start, stop, force_serial=args.trivial_parallel, upar=upar,
+                extra=extra)
         # We will write metadata as a separate step for now
         # write_metadata(args, model)
 
@@ -469,8 +1254,26 @@ if __name__ == '__main__':
     parser.add_argument('--m-type', choices=ALL_MTYPES, required=False, default=None)
     parser.add_argument('--e-type', choices=ALL_ETYPES, required=False, default=None)
     parser.add_argument('--cell-i', type=int, required=False, default=0)
+    parser.add_argument(
+        '--catalog', type=str, default=cell_catalog.CATALOG_FILE,
+        help='BBP only: cell catalog from cell_catalog.py, used to look up model metadata ' + \
+        'without building the cell. Cells missing from it are built as usual'
+    )
+    parser.add_argument(
+        '--probes', type=str, nargs='+', default=None,
+        help="BBP only: which recording points to record and save. Eg '--probes soma' for the soma only, " + \
+        "'--probes soma axon:2 dend:3' for the soma plus 2 axonal and 3 dendritic points evenly spaced " + \
+        "by path distance from the soma, 'dend:50-200um' for every dendritic point 50-200 um from the " + \
+        "soma, or explicit probeNames like 'axon_12'. The soma is always included. Default is all points"
+    )
     parser.add_argument('--cori-start', type=int, required=False, default=None, help='start cell')
     parser.add_argument('--cori-end', type=int, required=False, default=None, help='end cell')
+    parser.add_argument('--schedule', type=str, default=None,
+                        help='schedule from scheduler.py giving the cell and number of samples for each ' + \
+                        'SLURM_PROCID (requires --trivial-parallel). Ranks not in the schedule exit')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='work manifest from campaign.py. Each rank runs every n_tasks-th work unit ' + \
+                        '(cell, stimulus, number of samples and output file) in it, as with --trivial-parallel')
     parser.add_argument('--cori-csv', type=str, required=False, default=None,
                         help='When running BBP on cori, use SLURM_PROCID to compute m-type and e-type from the given cells csv')
     
@@ -492,6 +1295,36 @@ if __name__ == '__main__':
         help="create the params file (--param-file) and exit. Must use with --num"
     )
     parser.add_argument('--add-qa', action='store_true', default=False)
+    parser.add_argument(
+        '--quantize', choices=['global', 'probe', 'sample'], default='global',
+        help='how voltages are scaled into integers. global: fixed scale of {} per mV. '.format(VOLTS_SCALE) + \
+        'probe: each probe\'s range over all samples fills --volts-dtype. sample: each sample\'s ' + \
+        'range on each probe does. The scales and offsets are saved in voltsScale and voltsOffset ' + \
+        '(see readers.decode_volts())'
+    )
+    parser.add_argument('--volts-dtype', choices=sorted(VOLTS_DTYPES.keys()) + ['auto'], default='int16',
+                        help='integer type of the saved voltages (int8 needs --quantize probe or sample). ' + \
+                        'auto: int8 if it stores every voltage to within --volts-tolerance, else int16')
+    parser.add_argument('--volts-tolerance', type=float, default=0.5,
+                        help='with --volts-dtype auto, coarsest voltage resolution (mV) to accept int8 at')
+    parser.add_argument(
+        '--swmr', action='store_true', default=False,
+        help='write each sample as soon as it is done, in HDF5 single-writer/multiple-reader mode, ' + \
+        'so the file can be read during the run (see readers.py). One rank per file only'
+    )
+    parser.add_argument('--swmr-flush-every', type=int, default=10,
+                        help='with --swmr, number of samples between flushes (and updates of nValid)')
+    parser.add_argument(
+        '--append', action='store_true', default=False,
+        help='add the samples as new rows at the end of --outfile (creating it if needed) instead of ' + \
+        'writing a new file. Jobs appending to the same file take turns, using a lock on <outfile>.lock'
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true', default=False,
+        help='do every stage in one launch: create --param-file, create --outfile, write ' + \
+        '--metadata-file, then simulate. Stages whose output already exists are skipped, ' + \
+        'including the simulation if --outfile is complete'
+    )
 
     parser.add_argument(
         '--plot', nargs='*',
@@ -514,6 +1347,20 @@ if __name__ == '__main__':
         "See --params. When multithreaded, this is the total number over all ranks, " + \
         "except when using --trivial-parallel"
     )
+    parser.add_argument(
+        '--target-pass', type=int, default=None,
+        help="instead of a fixed number of attempts, keep drawing random params until this many " + \
+        "samples pass QA (over all ranks, or per rank with --trivial-parallel). Only passing " + \
+        "samples are saved, and the output file is created at the final size"
+    )
+    parser.add_argument(
+        '--max-attempts', type=int, default=None,
+        help="with --target-pass, give up after this many simulations in total (default 10x the target)"
+    )
+    parser.add_argument(
+        '--target-batch', type=int, default=16,
+        help="with --target-pass, number of samples each rank simulates between checks of the global count"
+    )
     parser.add_argument(
         '--trivial-parallel', action='store_true', default=False, required=False,
         help='each process runs all --num samples, with each rank writing output to a ' + \
@@ -537,6 +1384,16 @@ if __name__ == '__main__':
         help='do not save parameter values in the output nwb. ' + \
         'You better have saved them using --param-file'
     )
+    parser.add_argument(
+        '--reject-model', type=str, default=None,
+        help='npz file from rejection.py. Random draws predicted to fail QA are rejected before ' + \
+        'simulating; the importance weight of each kept sample is saved in sampleWeight'
+    )
+    parser.add_argument(
+        '--min-accept', type=float, default=0.05,
+        help='with --reject-model, lowest acceptance probability for any draw (bounds the weights). ' + \
+        'Must be in (0, 1]'
+    )
     parser.add_argument(
         '--linear', action='store_true', default=False,
         help='when selecting random params, distribute them uniformly' + \
@@ -546,7 +1403,16 @@ if __name__ == '__main__':
     # CHOOSE STIMULUS
     parser.add_argument(
         '--stim-file', type=str, default=os.path.join('stims', 'chaotic_2.csv'),
-        help="csv to use as the stimulus")
+        help="csv to use as the stimulus, or a stimulus library entry as library.h5:<name>:<row> (see stimulus.py)")
+    parser.add_argument(
+        '--stim-family', choices=stimulus.FAMILIES.keys(), default=None,
+        help="instead of --stim-file, give each sample its own random stimulus from this family " + \
+        "in stimulus.py. Only the generator params (stimPar) and seed (stimSeed) of each sample are saved"
+    )
+    parser.add_argument(
+        '--stim-seed', type=int, default=None,
+        help="with --stim-family, base seed for the stimuli (default: random, saved as stimSeedBase)"
+    )
     parser.add_argument(
         '--stim-dc-offset', type=float, default=0.0,
         help="apply a DC offset to the stimulus (shift it). Happens after --stim-multiplier"
@@ -557,12 +1423,74 @@ if __name__ == '__main__':
     )
 
     parser.add_argument(
-        '--tstart', type=int, default=None, required=False,
-        help='when to start the recording'
+        '--tstart', type=float, default=None, required=False,
+        help='when to start the recording (ms)'
     )
     parser.add_argument(
-        '--tstop', type=int, default=None, required=False,
-        help='when to stop the recording'
+        '--tstop', type=float, default=None, required=False,
+        help='when to stop the recording (ms). The simulation still runs for the whole stimulus'
+    )
+    parser.add_argument(
+        '--rec-dt', type=float, default=None, required=False,
+        help='record (and save) only every --rec-dt ms, rounded to a multiple of --dt. ' + \
+        'Default is to record every timestep'
+    )
+
+    parser.add_argument(
+        '--early-stop', action='store_true', default=False,
+        help='periodically check the soma voltage during each simulation and abandon it on NaN, ' + \
+        'runaway voltage, or depolarization block. The reason is saved in the stopQA dataset ' + \
+        '(0 = ran to completion, 1 = NaN, 2 = runaway, 3 = block) and the trace is padded'
+    )
+    parser.add_argument(
+        '--early-stop-check-ms', type=float, default=50.0,
+        help='with --early-stop, simulated time (ms) between checks'
+    )
+    parser.add_argument(
+        '--block-ms', type=float, default=100.0,
+        help='with --early-stop, how long (ms) the soma must stay depolarized to count as block'
+    )
+
+    parser.add_argument(
+        '--nthread', type=int, default=1,
+        help='BBP only: number of NEURON threads to run each cell on (see bench_threads.py ' + \
+        'for choosing ranks x threads per node)'
+    )
+    parser.add_argument(
+        '--multisplit', action='store_true', default=False,
+        help='BBP only: with --nthread, split each cell at the soma so its pieces run on ' + \
+        'different threads (otherwise one cell only uses one thread)'
+    )
+
+    parser.add_argument(
+        '--prerun', type=float, default=0,
+        help='relax each cell for this many ms at zero current before the stimulus starts, ' + \
+        'so the recorded traces start from steady state rather than the hoc resting potential'
+    )
+    parser.add_argument(
+        '--prerun-mode', choices=['params', 'default'], default='params',
+        help="with --prerun, 'params' relaxes every parameter set separately, 'default' relaxes " + \
+        "once per rank at the default params and starts every sample from that state (cheaper)"
+    )
+
+    parser.add_argument(
+        '--prescreen', action='store_true', default=False,
+        help='before each full simulation, run a cheap one (soma only, coarse dt, ' + \
+        'stimulus prefix) and skip the full simulation if it does not pass QA. ' + \
+        'Skipped samples are marked in the screenQA dataset'
+    )
+    parser.add_argument(
+        '--prescreen-dt', type=float, default=0.1,
+        help='timestep (ms) for the prescreen simulation. Rounded to a multiple of --dt'
+    )
+    parser.add_argument(
+        '--prescreen-frac', type=float, default=0.5,
+        help='fraction of the stimulus to simulate in the prescreen'
+    )
+    parser.add_argument(
+        '--prescreen-calibrate', type=int, default=0,
+        help='run the full simulation for the first N samples on each rank regardless of the ' + \
+        'prescreen result, to measure false rejections'
     )
 
     parser.add_argument('--print-every', type=int, default=1000)
@@ -572,9 +1500,10 @@ if __name__ == '__main__':
     
     args = parser.parse_args()
 
-    if args.tstart or args.tstop:
-        raise ValueError('--tstart and --tstop not yet implemented')
-
     log.basicConfig(format='%(asctime)s %(message)s', level=log.DEBUG if args.debug else log.INFO)
 
-    main(args)
+    args.work_unit = None
+    if args.manifest:
+        run_manifest(args)
+    else:
+        main(args)
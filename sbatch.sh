@@ -38,9 +38,8 @@ echo "OUTFILE" $OUTFILE
 args="--outfile $OUTFILE --stim-file ${stimfile} --param-file ${paramfile} \
       --model $MODELNAME --num $NSAMPLES --print-every 1000"
 
-srun -n 1 python run.py $args --create-params # create file that lists param values sampled
-srun -n 1 python run.py $args --create # create output file
-srun --label -n 64 python run.py $args 
+# Create the params file and the output file, then simulate, all in one launch
+srun --label -n 64 python run.py $args --pipeline
 
 chmod -R a+r $RUNDIR
 
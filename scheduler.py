@@ -0,0 +1,315 @@
+"""
+Assign BBP cells to ranks and nodes from per-cell cost estimates
+
+With --cori-csv, every cell gets the same number of ranks, and nodes are
+packed with a fixed number of ranks regardless of how much memory each
+cell needs. Instead, estimate for each cell the time per sample and the
+memory per rank, then:
+  - give each cell a number of ranks proportional to its total work
+    (samples x sec/sample), so all cells finish at about the same time
+  - pack the ranks onto nodes largest-memory-first, so no node runs out
+    of memory (nodes may be left with idle cores)
+
+Costs come from a calibration pass (--calibrate, which simulates a few
+samples of each cell) where available, and otherwise are extrapolated
+from nseg in the cell catalog (see cell_catalog.py).
+
+$ python scheduler.py --calibrate calibration.json --cells-csv allcells.csv --stim-file stims/chaotic_2.csv
+$ python scheduler.py --cells-csv allcells.csv --calibration calibration.json \
+    --nodes 2 --cores-per-node 128 --mem-per-node 96 --num 40 --out schedule.json
+
+and pass --schedule schedule.json to run.py (with --trivial-parallel)
+"""
+from __future__ import print_function
+
+import csv
+import json
+import logging as log
+from argparse import ArgumentParser
+
+import cell_catalog
+
+# Used when a cost can be neither measured nor extrapolated
+DEFAULT_SEC_PER_SEG = 0.01 # sec/sample per segment
+DEFAULT_MB_PER_SEG = 0.1
+BASE_RSS_MB = 200.0 # python + NEURON + mechanisms, before building the cell
+
+
+def read_cells_csv(filename, start=None, end=None):
+    """
+    Return [(bbp_name, m_type, e_type)] for rows [start, end) of a cells csv (eg allcells.csv)
+    """
+    with open(filename) as infile:
+        rows = [tuple(row[:3]) for row in csv.reader(infile, delimiter=',') if row]
+    return rows[start:end]
+
+
+def find_cell_i(cells, m_type, e_type, bbp_name):
+    """
+    The index of the clone of (m_type, e_type) in cells.json whose model_directory is bbp_name
+    """
+    for cell_i, cell_kwargs in enumerate(cells[m_type][e_type]):
+        if cell_kwargs['model_directory'] == bbp_name:
+            return cell_i
+    return 0
+
+
+class CellCost(object):
+    def __init__(self, bbp_name, m_type, e_type, cell_i, nseg, sec_per_sample, rss_mb, measured):
+        self.bbp_name = bbp_name
+        self.m_type = m_type
+        self.e_type = e_type
+        self.cell_i = cell_i
+        self.nseg = nseg
+        self.sec_per_sample = sec_per_sample
+        self.rss_mb = rss_mb
+        self.measured = measured
+
+
+def estimate_costs(rows, catalog, calibration):
+    """
+    Return a CellCost for each (bbp_name, m_type, e_type). Cells without
+    calibration data get costs scaled by nseg from the calibrated cells
+    """
+    with open('cells.json') as infile:
+        cells = json.load(infile)
+
+    def nseg_of(bbp_name):
+        if bbp_name in calibration:
+            return calibration[bbp_name]['nseg']
+        if bbp_name in catalog:
+            return catalog[bbp_name]['nseg']
+        return None
+
+    # Per-segment costs of the calibrated cells, for extrapolating to the rest
+    measured = [c for c in calibration.values() if c.get('nseg')]
+    if measured:
+        sec_per_seg = sum(c['sec_per_sample'] for c in measured) / sum(c['nseg'] for c in measured)
+        mb_per_seg = sum(max(c['rss_mb'] - BASE_RSS_MB, 0) for c in measured) / sum(c['nseg'] for c in measured)
+    else:
+        sec_per_seg, mb_per_seg = DEFAULT_SEC_PER_SEG, DEFAULT_MB_PER_SEG
+    median_nseg = sorted(n for n in map(nseg_of, (row[0] for row in rows)) if n) or [1000]
+    median_nseg = median_nseg[len(median_nseg) // 2]
+
+    costs = []
+    for bbp_name, m_type, e_type in rows:
+        cell_i = find_cell_i(cells, m_type, e_type, bbp_name)
+        nseg = nseg_of(bbp_name) or median_nseg
+        if bbp_name in calibration:
+            cal = calibration[bbp_name]
+            costs.append(CellCost(bbp_name, m_type, e_type, cell_i, nseg,
+                                  cal['sec_per_sample'], cal['rss_mb'], True))
+        else:
+            if bbp_name not in catalog:
+                log.warning("{} is in neither the calibration nor the catalog, assuming nseg = {}".format(
+                    bbp_name, nseg))
+            costs.append(CellCost(bbp_name, m_type, e_type, cell_i, nseg,
+                                  sec_per_seg * nseg, BASE_RSS_MB + mb_per_seg * nseg, False))
+    return costs
+
+
+def _split(spare, work):
+    """
+    Split spare ranks among the cells in proportion to work, by the largest remainder method
+    """
+    total_work = sum(work.values())
+    if total_work <= 0:
+        work = {name: 1.0 for name in work}
+        total_work = float(len(work))
+    shares = {name: spare * w / total_work for name, w in work.items()}
+    split = {name: int(share) for name, share in shares.items()}
+    leftover = spare - sum(split.values())
+    for name in sorted(shares, key=lambda name: shares[name] - int(shares[name]), reverse=True)[:leftover]:
+        split[name] += 1
+    return split
+
+
+def allocate_ranks(costs, nsamples, total_ranks):
+    """
+    {bbp_name: number of ranks} proportional to each cell's total work,
+    at least one each, and no more than nsamples each. Ranks a cell
+    cannot use go to the other cells; only if every cell has nsamples
+    ranks are some left over
+    """
+    if total_ranks < len(costs):
+        raise ValueError("{} ranks is not enough for {} cells".format(total_ranks, len(costs)))
+    work = {c.bbp_name: c.sec_per_sample * nsamples for c in costs}
+
+    # Give each cell one rank, then split the rest, again among the cells
+    # below the cap until none are capped in a round
+    ranks = {name: 1 for name in work}
+    uncapped = [name for name in work if ranks[name] < nsamples]
+    spare = total_ranks - len(costs)
+    while spare > 0 and uncapped:
+        for name, n in _split(spare, {name: work[name] for name in uncapped}).items():
+            ranks[name] += min(n, nsamples - ranks[name])
+        spare = total_ranks - sum(ranks.values())
+        uncapped = [name for name in uncapped if ranks[name] < nsamples]
+    if spare > 0:
+        log.warning("Every cell has one rank per sample, leaving {} ranks idle".format(spare))
+    return ranks
+
+
+def pack_nodes(costs, ranks, nnodes, cores_per_node, mem_per_node_mb):
+    """
+    Place every rank on a node without exceeding its cores or memory,
+    first-fit decreasing by memory per rank. Ranks that fit nowhere are
+    dropped (that cell runs on fewer ranks).
+
+    Return a list (per node) of lists of CellCosts (one per rank)
+    """
+    nodes = [[] for _ in range(nnodes)]
+    mem_free = [mem_per_node_mb] * nnodes
+    for cost in sorted(costs, key=lambda c: c.rss_mb, reverse=True):
+        placed = 0
+        for _ in range(ranks[cost.bbp_name]):
+            for node_i in range(nnodes):
+                if len(nodes[node_i]) < cores_per_node and mem_free[node_i] >= cost.rss_mb:
+                    nodes[node_i].append(cost)
+                    mem_free[node_i] -= cost.rss_mb
+                    placed += 1
+                    break
+            else:
+                break
+        if placed == 0:
+            raise ValueError("{} needs {:.0f} MB per rank, which does not fit on any node".format(
+                cost.bbp_name, cost.rss_mb))
+        if placed < ranks[cost.bbp_name]:
+            log.warning("Only room for {} of {} ranks for {}".format(placed, ranks[cost.bbp_name], cost.bbp_name))
+        ranks[cost.bbp_name] = placed
+    return nodes
+
+
+def make_schedule(costs, nsamples, nnodes, cores_per_node, mem_per_node_mb):
+    """
+    Return the schedule: for every rank (numbered node by node, cores_per_node
+    per node, as with srun --ntasks-per-node), the cell it runs and how many
+    samples. Ranks without an entry are left idle
+    """
+    ranks = allocate_ranks(costs, nsamples, nnodes * cores_per_node)
+    nodes = pack_nodes(costs, ranks, nnodes, cores_per_node, mem_per_node_mb)
+
+    schedule = {'cores_per_node': cores_per_node, 'ranks': {}, 'cells': {}}
+    done = {c.bbp_name: 0 for c in costs}
+    for node_i, node in enumerate(nodes):
+        for slot, cost in enumerate(node):
+            n_ranks = ranks[cost.bbp_name]
+            # Split the samples as evenly as possible among the cell's ranks. Each
+            # rank draws its own and writes its own file, so only the count matters
+            j = done[cost.bbp_name]
+            done[cost.bbp_name] += 1
+            schedule['ranks'][str(node_i * cores_per_node + slot)] = {
+                'bbp_name': cost.bbp_name,
+                'm_type': cost.m_type,
+                'e_type': cost.e_type,
+                'cell_i': cost.cell_i,
+                'num': nsamples * (j + 1) // n_ranks - nsamples * j // n_ranks,
+                'node': node_i,
+            }
+    for cost in costs:
+        schedule['cells'][cost.bbp_name] = {
+            'ranks': ranks[cost.bbp_name],
+            'est_seconds': cost.sec_per_sample * nsamples / ranks[cost.bbp_name],
+            'rss_mb': cost.rss_mb,
+            'measured': cost.measured,
+        }
+    return schedule
+
+
+def calibrate_one(task):
+    """
+    Build one cell and time a few samples at its default params. Run in a fresh process per cell
+    """
+    import resource
+    import time
+
+    import models
+    import stimulus
+
+    bbp_name, m_type, e_type, cell_i, stim_file, dt, nsamples = task
+    model = models.bbp_class(e_type)(m_type, e_type, cell_i, log=log)
+    model.create_cell()
+    stim = stimulus.load_stim(stim_file, dt=dt) * model.STIM_MULTIPLIER
+
+    _start = time.time()
+    for _ in range(nsamples):
+        model.simulate(stim, dt)
+    return bbp_name, {
+        'sec_per_sample': (time.time() - _start) / nsamples,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'nseg': sum(sec.nseg for sec in model.entire_cell.all),
+    }
+
+
+def calibrate(args, rows):
+    import multiprocessing
+
+    with open('cells.json') as infile:
+        cells = json.load(infile)
+    tasks = [(bbp_name, m_type, e_type, find_cell_i(cells, m_type, e_type, bbp_name),
+              args.stim_file, args.dt, args.calib_samples)
+             for bbp_name, m_type, e_type in rows]
+
+    calibration = {}
+    pool = multiprocessing.Pool(args.procs, maxtasksperchild=1)
+    for bbp_name, result in pool.imap_unordered(calibrate_one, tasks):
+        log.info("{}: {:.2f} s/sample, {:.0f} MB".format(bbp_name, result['sec_per_sample'], result['rss_mb']))
+        calibration[bbp_name] = result
+    pool.close()
+    pool.join()
+
+    with open(args.calibrate, 'w') as outfile:
+        json.dump(calibration, outfile, indent=1, sort_keys=True)
+
+
+def main(args):
+    rows = read_cells_csv(args.cells_csv, args.start, args.end)
+
+    if args.calibrate:
+        calibrate(args, rows)
+        return
+
+    calibration = {}
+    if args.calibration:
+        with open(args.calibration) as infile:
+            calibration = json.load(infile)
+    costs = estimate_costs(rows, cell_catalog.load_catalog(args.catalog), calibration)
+
+    schedule = make_schedule(costs, args.num, args.nodes, args.cores_per_node, args.mem_per_node * 1024)
+    with open(args.out, 'w') as outfile:
+        json.dump(schedule, outfile, indent=1, sort_keys=True)
+
+    for bbp_name, cell in sorted(schedule['cells'].items(), key=lambda item: -item[1]['est_seconds']):
+        log.info("{}: {} ranks, ~{:.0f} s, {:.0f} MB/rank{}".format(
+            bbp_name, cell['ranks'], cell['est_seconds'], cell['rss_mb'],
+            '' if cell['measured'] else ' (estimated from nseg)'))
+    log.info("Wrote schedule for {} ranks to {}".format(len(schedule['ranks']), args.out))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--cells-csv', type=str, default='allcells.csv',
+                        help='csv of bbp_name,m_type,e_type (eg allcells.csv)')
+    parser.add_argument('--start', type=int, default=None, help='first row of --cells-csv to use')
+    parser.add_argument('--end', type=int, default=None, help='one past the last row of --cells-csv to use')
+    parser.add_argument('--catalog', type=str, default=cell_catalog.CATALOG_FILE)
+    parser.add_argument('--calibration', type=str, default=None,
+                        help='json written by --calibrate with measured costs')
+    parser.add_argument('--num', type=int, default=40, help='samples per cell')
+    parser.add_argument('--nodes', type=int, default=1)
+    parser.add_argument('--cores-per-node', type=int, default=128, help='ranks per node')
+    parser.add_argument('--mem-per-node', type=float, default=96, help='usable memory per node (GB)')
+    parser.add_argument('--out', type=str, default='schedule.json')
+
+    parser.add_argument('--calibrate', type=str, default=None,
+                        help='instead of scheduling, measure the costs of each cell and write them here')
+    parser.add_argument('--stim-file', type=str, default='stims/chaotic_2.csv', help='with --calibrate')
+    parser.add_argument('--dt', type=float, default=0.025, help='with --calibrate')
+    parser.add_argument('--calib-samples', type=int, default=2, help='with --calibrate, samples per cell')
+    parser.add_argument('--procs', type=int, default=1, help='with --calibrate, cells to run at once')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
@@ -0,0 +1,152 @@
+"""
+Local simulation server for interactive analysis
+
+Starting NEURON, loading the mechanisms and building a model takes much
+longer than simulating one trace, and analysis scripts (compute_similarity.py,
+visualize_similarity.py, notebooks) pay it in every process. This keeps a
+pool of warm worker processes, each with NEURON loaded and its most recent
+model and stimuli cached, behind a Unix socket (no network). Start it with
+
+$ python sim_server.py --workers 8 &
+
+and use it with
+
+>>> from sim_server import SimClient
+>>> client = SimClient()
+>>> traces = client.simulate([{'model': 'izhi', 'params': [0.02, 0.2, -65, 2], 'stim_file': 'stims/chirp23a.csv'}])
+
+Each request is a dict with keys:
+  model: a name in models.MODELS_BY_NAME, or 'BBP' (then also m_type, e_type, cell_i, probes)
+  params: physical parameters (default: the model's defaults)
+  stim: the stimulus (already scaled), or stim_file: a csv to load (and cache), scaled
+        by stim_multiplier (default: the model's STIM_MULTIPLIER)
+  dt, celsius, variables: as in BaseModel.simulate()
+and the result is the dict of traces from BaseModel.simulate().
+"""
+from __future__ import print_function
+
+import os
+import logging as log
+from argparse import ArgumentParser
+from multiprocessing.managers import BaseManager
+
+SOCKET = '/tmp/dl4neurons-sim-{}.sock'.format(os.getuid())
+AUTHKEY = 'dl4neurons-{}'.format(os.getuid()).encode()
+
+
+class SimManager(BaseManager):
+    pass
+
+
+# Worker state: the stimuli loaded so far, and the last BBP model (building
+# another BBP cell deletes the previous one's sections, so only one is kept)
+_stims = {}
+_bbp = {'key': None, 'model': None}
+
+
+def _get_stim(request, model_cls):
+    import numpy as np
+    import stimulus
+
+    if request.get('stim') is not None:
+        return np.asarray(request['stim'])
+    stim_file = request['stim_file']
+    if stim_file not in _stims:
+        _stims[stim_file] = stimulus.load_stim(stim_file)
+    return _stims[stim_file] * request.get('stim_multiplier', model_cls.STIM_MULTIPLIER)
+
+
+def _get_model(request):
+    import models
+
+    params = request.get('params') or ()
+    celsius = request.get('celsius', 34)
+    if request['model'] != 'BBP':
+        return models.MODELS_BY_NAME[request['model']](*params, log=log, celsius=celsius)
+
+    key = (request['m_type'], request['e_type'], request.get('cell_i', 0), tuple(request.get('probes') or ()))
+    if _bbp['key'] == key:
+        model = _bbp['model']
+        model.set_params(*params)
+    else:
+        model = models.bbp_class(key[1])(key[0], key[1], key[2], *params, log=log, celsius=celsius,
+                                         probes=request.get('probes'))
+        _bbp['key'], _bbp['model'] = key, model
+    models.h.celsius = celsius
+    return model
+
+
+def _simulate(request):
+    model = _get_model(request)
+    stim = _get_stim(request, type(model))
+    return model.simulate(stim, dt=request.get('dt', 0.025), variables=request.get('variables'))
+
+
+def _init_worker():
+    import models # load NEURON and the mechanisms once per worker
+
+
+class SimService(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def simulate(self, requests):
+        """
+        Simulate a batch of requests on the worker pool, and return their traces in order
+        """
+        return self.pool.map(_simulate, requests, chunksize=1)
+
+    def ping(self):
+        return os.getpid()
+
+
+class SimClient(object):
+    """
+    Connection to a running sim_server.py
+    """
+    def __init__(self, socket=SOCKET, authkey=AUTHKEY):
+        SimManager.register('service')
+        self.manager = SimManager(address=socket, authkey=authkey)
+        self.manager.connect()
+        self.service = self.manager.service()
+
+    def simulate(self, requests):
+        return self.service.simulate(list(requests))
+
+    def simulate_one(self, model, params, **kwargs):
+        request = dict(kwargs, model=model, params=list(params))
+        return self.simulate([request])[0]
+
+
+def serve(socket=SOCKET, nworkers=4, authkey=AUTHKEY):
+    import multiprocessing
+
+    if os.path.exists(socket):
+        os.remove(socket) # left over from a server that did not shut down cleanly
+
+    pool = multiprocessing.Pool(nworkers, initializer=_init_worker)
+    service = SimService(pool)
+    SimManager.register('service', callable=lambda: service)
+    manager = SimManager(address=socket, authkey=authkey)
+    server = manager.get_server()
+    os.chmod(socket, 0o600)
+
+    log.info("Serving {} workers on {}".format(nworkers, socket))
+    try:
+        server.serve_forever()
+    finally:
+        pool.terminate()
+        if os.path.exists(socket):
+            os.remove(socket)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--socket', type=str, default=SOCKET)
+    parser.add_argument('--workers', type=int, default=4)
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    serve(args.socket, args.workers)
@@ -1,6 +1,21 @@
 """
 This file defines the stimuli we use
+
+Generators make one stimulus (generate()) or a batch of them at once
+(generate_batch()), where any parameter can be a scalar shared by the batch
+or a sequence with one value per stimulus. Batches can be saved to an h5
+stimulus library, which run.py reads with --stim-file library.h5:<name>:<i>:
+
+$ python stimulus.py --out stims/library.h5 --name chirp_lin --generator chirp \
+    --num 16 --seed 0 --params amp=0.5 f0=1 f1=20,25,30,35,40,45,50,55,60,65,70,75,80,85,90,95
 """
+from __future__ import print_function
+
+import os
+import logging as log
+from argparse import ArgumentParser
+from collections import OrderedDict
+
 import numpy as np
 # from pynwb import TimeSeries
 
@@ -11,6 +26,43 @@ PULSELEN = 144
 POSTPULSE = 6
 TAU = 3
 
+
+def _column(val, k):
+    """
+    A stimulus parameter as a scalar, or as a (k, 1) column to broadcast against (k, n_pulse)
+    """
+    val = np.asarray(val, dtype=np.float64)
+    if val.ndim == 0:
+        return val
+    assert len(val) == k, "Per-stimulus parameters need one value per stimulus"
+    return val.reshape(k, 1)
+
+
+def _ar1_filter(b, a):
+    """
+    x[..., i] = a*x[..., i-1] + b[..., i] along the last axis, starting from x[..., -1] = 0
+    """
+    try:
+        from scipy.signal import lfilter
+        return lfilter([1.0], [1.0, -a], b, axis=-1)
+    except ImportError:
+        pass
+
+    # Without scipy, filter a block at a time as a scaled cumsum, with
+    # blocks short enough that a**-block does not lose precision
+    x = np.empty_like(b)
+    prev = np.zeros(b.shape[:-1] + (1,))
+    block = int(np.log(1e8) / -np.log(a)) if 0 < a < 1 else 1
+    block = max(1, min(block, b.shape[-1]))
+    powers = a ** np.arange(block, dtype=np.float64)
+    for s in range(0, b.shape[-1], block):
+        n = min(block, b.shape[-1] - s)
+        p = powers[:n]
+        x[..., s:s+n] = p * a * prev + p * np.cumsum(b[..., s:s+n] / p, axis=-1)
+        prev = x[..., s+n-1:s+n]
+    return x
+
+
 class StimulusGenerator(object):
 
     def __init__(self, *args, **kwargs):
@@ -19,19 +71,34 @@ class StimulusGenerator(object):
         self.pulselen = kwargs.pop('pulselen', PULSELEN)
         self.postpulse = kwargs.pop('postpulse', POSTPULSE)
 
-    def _pulse(self, n_pulse, **stim_args):
+    def _pulse(self, k, n_pulse, rng, **stim_args):
+        """
+        Return the (k, n_pulse) pulses. stim_args are scalars or (k, 1) columns
+        """
         raise NotImplementedError()
 
-    def generate(self, **stim_args):
+    def _t(self, n_pulse):
+        return np.arange(n_pulse, dtype=np.float64) * self.dt # ms
+
+    def generate(self, seed=None, **stim_args):
+        return self.generate_batch(1, seed=seed, **stim_args)[0]
+
+    def generate_batch(self, k, seed=None, **stim_args):
+        """
+        Return k stimuli as a (k, timepts) array. Random generators draw from seed
+        """
         n_pre = int(self.prepulse / self.dt)
         n_pulse = int(self.pulselen / self.dt)
         n_post = int(self.postpulse / self.dt)
         n_tot = n_pre + n_pulse + n_post
 
-        stim = np.zeros(n_tot, dtype=np.float64)
-        stim[n_pre:n_pre+n_pulse] = self._pulse(n_pulse, **stim_args)
+        rng = np.random.default_rng(seed)
+        stim_args = {name: _column(val, k) for name, val in stim_args.items()}
 
-        return stim
+        stims = np.zeros((k, n_tot), dtype=np.float64)
+        stims[:, n_pre:n_pre+n_pulse] = self._pulse(k, n_pulse, rng, **stim_args)
+
+        return stims
 
     def write_csv(self, filename, delimiter='\n', append=False, **stim_args):
         # NOT TESTED
@@ -41,51 +108,240 @@ class StimulusGenerator(object):
         with open(filename, mode) as f:
             np.savetxt(f, stim, delimiter=delimiter)
 
+    def write_library(self, filename, name, k, seed=None, **stim_args):
+        """
+        Generate k stimuli and save them to the h5 stimulus library as name
+        """
+        stims = self.generate_batch(k, seed=seed, **stim_args)
+        write_library(filename, name, stims, dt=self.dt, generator=type(self).__name__,
+                      seed=-1 if seed is None else seed, **stim_args)
+        return stims
+
 
 class StimGeneratorFromFile(StimulusGenerator):
-    # TODO: Not tested
     def __init__(self, filename, *args, **kwargs):
-        self.pulse = np.genfromtxt(dtype=np.float64)
+        self.pulse = np.genfromtxt(filename, dtype=np.float64)
+        dt = kwargs.get('dt', DT)
         if 'pulselen' in kwargs:
-            assert pulselen == len(self.stim), "If specifying pulselen, it must agree with the length of the file"
+            assert int(kwargs['pulselen'] / dt) == len(self.pulse), \
+                "If specifying pulselen, it must agree with the length of the file"
+        kwargs['pulselen'] = len(self.pulse) * dt
         super(StimGeneratorFromFile, self).__init__(*args, **kwargs)
 
-    def _pulse(self, n_pulse, **stim_args):
-        return self.pulse
+    def _pulse(self, k, n_pulse, rng, **stim_args):
+        return np.tile(self.pulse[:n_pulse], (k, 1))
     
 
 class RampGenerator(StimulusGenerator):
-    def _pulse(self, n_pulse, rampval=0.):
-        return np.linspace(start=0, stop=rampval, num=n_pulse, dtype=np.float64)
+    def _pulse(self, k, n_pulse, rng, rampval=0.):
+        return np.zeros((k, 1)) + rampval * np.linspace(start=0, stop=1, num=n_pulse, dtype=np.float64)
 
     
 class NegRampGenerator(RampGenerator):
-    def _pulse(self, n_pulse, rampval=0.):
-        return np.linspace(start=rampval, stop=0, num=n_pulse, dtype=np.float64)
+    def _pulse(self, k, n_pulse, rng, rampval=0.):
+        return np.zeros((k, 1)) + rampval * np.linspace(start=1, stop=0, num=n_pulse, dtype=np.float64)
 
     
 class StepGenerator(StimulusGenerator):
-    def _pulse(self, n_pulse, stepval):
-        return np.ones(n_pulse, dtype=np.float64) * stepval
+    def _pulse(self, k, n_pulse, rng, stepval):
+        return np.ones((k, n_pulse), dtype=np.float64) * stepval
 
 class NoiseGenerator(StimulusGenerator):
-    def _pulse(self, n_pulse, mean=0., sd=1., tau=TAU):
-        pulse = np.zeros(n_pulse, dtype=np.float64)
-        for i in range(1, n_pulse):
-            diff = ((mean - pulse[i-1])*self.dt/tau
-                    + sd*np.sqrt(2*self.dt/tau)*np.random.normal(0, 1))
-            pulse[i] = pulse[i-1] + diff
+    """
+    Ornstein-Uhlenbeck noise with the given mean, sd and time constant tau (ms), starting from 0
+    """
+    def _pulse(self, k, n_pulse, rng, mean=0., sd=1., tau=TAU):
+        # pulse[i] = (1 - dt/tau)*pulse[i-1] + mean*dt/tau + sd*sqrt(2*dt/tau)*N(0, 1)
+        if np.ndim(tau):
+            # The filter coefficient depends on tau, so each distinct tau is filtered separately
+            pulse = np.empty((k, n_pulse), dtype=np.float64)
+            for i in range(k):
+                row_args = {'mean': np.ravel(mean)[i] if np.ndim(mean) else mean,
+                            'sd': np.ravel(sd)[i] if np.ndim(sd) else sd}
+                pulse[i] = self._pulse(1, n_pulse, rng, tau=np.ravel(tau)[i], **row_args)[0]
+            return pulse
 
-        return pulse
+        a = 1 - self.dt/tau
+        drive = np.zeros((k, n_pulse), dtype=np.float64)
+        drive[:, 1:] = mean*self.dt/tau + sd*np.sqrt(2*self.dt/tau)*rng.standard_normal((k, n_pulse-1))
+        return _ar1_filter(drive, a)
 
 
 class SinGenerator(StimulusGenerator):
-    pass # TODO
+    """
+    amp*sin(2*pi*freq*t + phase) + offset, with freq in Hz
+    """
+    def _pulse(self, k, n_pulse, rng, amp=1., freq=10., phase=0., offset=0.):
+        t = self._t(n_pulse) / 1000.0 # s
+        return np.zeros((k, 1)) + amp * np.sin(2*np.pi*freq*t + phase) + offset
 
 
 class ChirpGenerator(StimulusGenerator):
-    pass # TODO
+    """
+    Sine sweep from f0 to f1 (Hz) over the pulse, linear or exponential in frequency
+    """
+    def __init__(self, *args, **kwargs):
+        self.method = kwargs.pop('method', 'linear')
+        assert self.method in ('linear', 'exponential')
+        super(ChirpGenerator, self).__init__(*args, **kwargs)
+
+    def _phase(self, t, f0, f1):
+        T = t[-1] if len(t) > 1 else 1.0
+        linear = 2*np.pi * (f0*t + (f1 - f0) * t**2 / (2*T))
+        if self.method == 'linear':
+            return linear
+        # With f0 == f1 there is no sweep, and the linear form is the constant frequency limit
+        ratio = f1 / f0
+        flat = np.isclose(ratio, 1.0)
+        log_ratio = np.where(flat, 1.0, np.log(ratio))
+        return np.where(flat, linear, 2*np.pi * f0 * T / log_ratio * (ratio**(t/T) - 1))
+
+    def _envelope(self, t, **stim_args):
+        if stim_args:
+            raise TypeError("Unknown {} parameters: {}".format(type(self).__name__, ', '.join(sorted(stim_args))))
+        return 1.0
+
+    def _pulse(self, k, n_pulse, rng, amp=1., f0=1., f1=50., offset=0., **stim_args):
+        t = self._t(n_pulse) / 1000.0 # s
+        envelope = self._envelope(t, **stim_args)
+        return np.zeros((k, 1)) + amp * envelope * np.sin(self._phase(t, f0, f1)) + offset
+
+
+class DampedChirpGenerator(ChirpGenerator):
+    """
+    Chirp whose amplitude decays exponentially with time constant decay (ms)
+    """
+    def _envelope(self, t, decay=50.):
+        return np.exp(-t*1000.0 / decay)
+
+
+GENERATORS = {
+    'ramp': RampGenerator,
+    'neg_ramp': NegRampGenerator,
+    'step': StepGenerator,
+    'noise': NoiseGenerator,
+    'sin': SinGenerator,
+    'chirp': ChirpGenerator,
+    'damped_chirp': DampedChirpGenerator,
+}
+
+
+
+class StimFamily(object):
+    """
+    A generator with a range for each of its parameters, to draw a random
+    stimulus for each sample. Everything is determined by the sample's seed,
+    so a stimulus can be regenerated from its seed and parameters
+    """
+    def __init__(self, generator_cls, param_ranges, **gen_kwargs):
+        self.generator = generator_cls(**gen_kwargs)
+        self.param_names = list(param_ranges.keys())
+        self.param_ranges = list(param_ranges.values())
+
+    def draw_params(self, seed):
+        rng = np.random.default_rng([seed, 0])
+        return np.array([rng.uniform(lo, hi) for lo, hi in self.param_ranges])
+
+    def generate(self, params, seed):
+        return self.generator.generate(seed=[seed, 1], **dict(zip(self.param_names, params)))
+
+    def sample(self, seed):
+        """
+        Return (params, stimulus) for the sample with this seed
+        """
+        params = self.draw_params(seed)
+        return params, self.generate(params, seed)
+
 
+# name: (generator, generator kwargs, parameter ranges)
+FAMILIES = {
+    'ou': (NoiseGenerator, {}, OrderedDict([('mean', (0.0, 1.0)), ('sd', (0.1, 1.0)), ('tau', (1.0, 10.0))])),
+    'sin': (SinGenerator, {}, OrderedDict([('amp', (0.1, 1.0)), ('freq', (1.0, 50.0)), ('offset', (0.0, 0.5))])),
+    'chirp': (ChirpGenerator, {'method': 'linear'},
+              OrderedDict([('amp', (0.1, 1.0)), ('f0', (0.5, 5.0)), ('f1', (10.0, 100.0)), ('offset', (0.0, 0.5))])),
+    'exp_chirp': (ChirpGenerator, {'method': 'exponential'},
+                  OrderedDict([('amp', (0.1, 1.0)), ('f0', (0.5, 5.0)), ('f1', (10.0, 100.0)), ('offset', (0.0, 0.5))])),
+    'damped_chirp': (DampedChirpGenerator, {'method': 'linear'},
+                     OrderedDict([('amp', (0.1, 1.0)), ('f0', (0.5, 5.0)), ('f1', (10.0, 100.0)),
+                                  ('offset', (0.0, 0.5)), ('decay', (20.0, 150.0))])),
+}
+
+
+def get_family(name, dt=DT):
+    generator_cls, gen_kwargs, param_ranges = FAMILIES[name]
+    return StimFamily(generator_cls, param_ranges, dt=dt, **gen_kwargs)
+
+
+def sample_seed(base, *index):
+    """
+    Seed for one sample, from the run's base seed and the sample's index (eg (rank, i))
+    """
+    return int(np.random.SeedSequence([base] + list(index)).generate_state(1)[0])
+
+
+def regenerate(f, row):
+    """
+    The stimulus of one sample (row) of an output file written with
+    run.py --stim-family, scaled as it was in the simulation
+    """
+    def _str(x):
+        return x.decode() if isinstance(x, bytes) else x
+
+    family = get_family(_str(f.attrs['stimFamily']), dt=f.attrs['stimDt'])
+    stim = family.generate(f['stimPar'][row], int(f['stimSeed'][row]))
+    return stim.astype(np.float32) * f.attrs['stimMultiplier'] + f.attrs['stimDcOffset']
+
+def write_library(filename, name, stims, dt=DT, **attrs):
+    """
+    Save a (k, timepts) batch of stimuli to the h5 stimulus library as dataset name
+    """
+    import h5py
+
+    with h5py.File(filename, 'a') as f:
+        if name in f:
+            del f[name]
+        dset = f.create_dataset(name, data=np.atleast_2d(stims), dtype=np.float32)
+        dset.attrs['dt'] = dt
+        for key, val in attrs.items():
+            dset.attrs[key] = val
+
+
+def _parse_stim_spec(spec):
+    """
+    (path, library dataset name or None, row) from a csv path or library.h5:<name>[:<row>]
+    """
+    if '.h5:' not in spec:
+        return spec, None, 0
+    path, rest = spec.split('.h5:', 1)
+    name, _, row = rest.partition(':')
+    return path + '.h5', name, int(row or 0)
+
+
+def load_stim(spec, dt=None):
+    """
+    Load one stimulus from a csv file, or from the library as library.h5:<name>[:<row>]
+    """
+    path, name, row = _parse_stim_spec(spec)
+    if name is None:
+        return np.genfromtxt(path, dtype=np.float32)
+
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        dset = f[name]
+        if dt is not None and not np.isclose(dset.attrs.get('dt', dt), dt):
+            log.warning("Stimulus {} was generated with dt = {}, but dt = {}".format(spec, dset.attrs['dt'], dt))
+        return dset[row].astype(np.float32)
+
+
+def stim_name(spec):
+    """
+    Short name for a stimulus spec, as stored in the stimName attribute
+    """
+    path, name, row = _parse_stim_spec(spec)
+    if name is None:
+        return os.path.splitext(os.path.basename(path))[0]
+    return '{}_{:02d}'.format(name, row)
 
 
 n_stims = 8
@@ -95,19 +351,75 @@ stepvals = [4.0 + 0.5*i for i in range(n_stims)]
 noise_means = [4.0 + 0.5*i for i in range(n_stims)]
 sds = [0.2*(i + 1) for i in range(n_stims)]
 
-stims = {
-    'ramp': [RampGenerator().generate(rampval=val) for val in rampvals],
-    # 'neg_ramp': [NegRampGenerator().generate(rampval=-val) for val in rampvals],
-    'step': [StepGenerator().generate(stepval=val) for val in stepvals],
-    'noise': [NoiseGenerator().generate(mean=mean, sd=sd)
-              for mean, sd in zip(noise_means, sds)],
-    'sin': [],
-    'chirp': [],
-}
+STIMS_SEED = 0
+_stims = None
+
+def get_stims():
+    """
+    The standard stimuli, generated the first time they are asked for. The
+    noise stimuli come from STIMS_SEED, not from the global np.random state,
+    so they are the same in every process however np.random was seeded
+    """
+    global _stims
+    if _stims is None:
+        _stims = {
+            'ramp': [RampGenerator().generate(rampval=val) for val in rampvals],
+            # 'neg_ramp': [NegRampGenerator().generate(rampval=-val) for val in rampvals],
+            'step': [StepGenerator().generate(stepval=val) for val in stepvals],
+            'noise': [NoiseGenerator().generate(seed=[STIMS_SEED, i], mean=mean, sd=sd)
+                      for i, (mean, sd) in enumerate(zip(noise_means, sds))],
+            'sin': [],
+            'chirp': [],
+        }
+    return _stims
+
+def __getattr__(name):
+    # Keep `from stimulus import stims` working without generating them on import
+    if name == 'stims':
+        return get_stims()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def add_stims(nwb):
-    for stim_type, stim_list in iter(stims.items()):
+    for stim_type, stim_list in iter(get_stims().items()):
         for i, stim in enumerate(stim_list):
             stim_name = '{}_{:02d}'.format(stim_type, i)
             stim_timeseries = TimeSeries(stim_name, stim, 'nA', rate=1.0/DT)
             nwb.add_stimulus(stim_timeseries)
+
+
+def _parse_param(text):
+    name, _, val = text.partition('=')
+    vals = [float(x) for x in val.split(',')]
+    return name, vals[0] if len(vals) == 1 else vals
+
+
+def main(args):
+    gen_kwargs = {'dt': args.dt, 'prepulse': args.prepulse, 'pulselen': args.pulselen, 'postpulse': args.postpulse}
+    if args.method:
+        gen_kwargs['method'] = args.method
+    generator = GENERATORS[args.generator](**gen_kwargs)
+    stim_args = dict(_parse_param(text) for text in args.params)
+    stims = generator.write_library(args.out, args.name, args.num, seed=args.seed, **stim_args)
+    log.info("Wrote {} stimuli of {} timepoints to {}:{}".format(stims.shape[0], stims.shape[1], args.out, args.name))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--out', type=str, required=True, help='h5 stimulus library to write to (created if needed)')
+    parser.add_argument('--name', type=str, required=True, help='name of the batch in the library')
+    parser.add_argument('--generator', choices=GENERATORS.keys(), required=True)
+    parser.add_argument('--method', choices=['linear', 'exponential'], default=None, help='frequency sweep for chirps')
+    parser.add_argument('--num', type=int, default=1, help='number of stimuli to generate')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--params', type=str, nargs='*', default=[],
+                        help='generator parameters as name=value, or name=v1,v2,... with one value per stimulus')
+    parser.add_argument('--dt', type=float, default=DT)
+    parser.add_argument('--prepulse', type=float, default=PREPULSE, help='ms of zeros before the pulse')
+    parser.add_argument('--pulselen', type=float, default=PULSELEN, help='ms')
+    parser.add_argument('--postpulse', type=float, default=POSTPULSE, help='ms of zeros after the pulse')
+
+    args = parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(message)s', level=log.INFO)
+
+    main(args)
@@ -0,0 +1,39 @@
+"""
+models.select_probes() on a toy list of recording points
+"""
+import pytest
+
+pytest.importorskip('neuron')
+
+from models import select_probes
+
+NAMES = ['soma', 'axon_0', 'dend_3', 'axon_5', 'apic_2', 'dend_8', 'apic_9']
+DISTANCES = [0.0, 30.0, 40.0, 300.0, 150.0, 90.0, 600.0]
+
+
+def test_all_by_default():
+    assert select_probes(NAMES) == list(range(len(NAMES)))
+
+
+def test_soma_always_included():
+    assert select_probes(NAMES, ['apic_2'], DISTANCES) == [0, 4]
+
+
+def test_evenly_spaced_by_distance():
+    # Dendritic probes by distance: dend_3 (40), dend_8 (90), apic_2 (150), apic_9 (600)
+    assert select_probes(NAMES, ['dend:2'], DISTANCES) == [0, 2, 6]
+    assert select_probes(NAMES, ['dend:1'], DISTANCES) == [0, 2]
+    assert select_probes(NAMES, ['dend:10'], DISTANCES) == [0, 2, 4, 5, 6]
+    assert select_probes(NAMES, ['axon:2'], DISTANCES) == [0, 1, 3]
+
+
+def test_distance_range():
+    assert select_probes(NAMES, ['dend:50-200um'], DISTANCES) == [0, 4, 5]
+    assert select_probes(NAMES, ['axon:0-100um', 'dend:500-1000um'], DISTANCES) == [0, 1, 6]
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        select_probes(NAMES, ['basal_1'], DISTANCES)
+    with pytest.raises(ValueError):
+        select_probes(NAMES, ['dend:2'])
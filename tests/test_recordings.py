@@ -0,0 +1,53 @@
+"""
+Reusing a model must not leave the previous run's vectors recording
+"""
+import pytest
+
+pytest.importorskip('neuron')
+
+import numpy as np
+
+import models
+from models import h
+
+
+class Passive(models.BaseModel):
+    """
+    Single passive compartment (built-in mechanisms only, no compiled mod files needed)
+    """
+    PARAM_NAMES = ('g_pas',)
+    DEFAULT_PARAMS = (0.001,)
+
+    def create_cell(self):
+        self.cell = h.Section() # do not garbage collect
+        self.cell.insert('pas')
+        self.cell(0.5).pas.g = self.g_pas
+        return self.cell
+
+    def recordable_variables(self):
+        return {'v': lambda: h.cell(0.5)._ref_v}
+
+
+class CountingMonitor(models.SimMonitor):
+    """
+    Count the live hoc Vectors (recordings, the stimulus) part way through each run
+    """
+    def __init__(self):
+        super(CountingMonitor, self).__init__(check_every=5.0)
+        self.counts = []
+
+    def check(self, v, checked_up_to, dt):
+        self.counts.append(h.List('Vector').count())
+        return models.STOP_NONE
+
+
+def test_live_recordings_constant_across_runs():
+    model = Passive(log=lambda *args: None)
+    stim = np.zeros(400)
+    counts = []
+    for _ in range(4):
+        monitor = CountingMonitor()
+        buf = np.zeros(len(stim) + 1)
+        model.simulate(stim, dt=0.025, monitor=monitor, variables={'v'}, out=buf, prerun=5)
+        counts.append(monitor.counts[0])
+    assert len(set(counts)) == 1, counts
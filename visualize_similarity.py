@@ -76,16 +76,17 @@ def traces(sim, is_sim, circle_params, true_vs, pred_vs, trace_axs, colors, exp_
     trace_axs[-1].set_ylabel("V_m")
 
 
-def similarity_heatmap(similarity_file, param_x=0, param_y=1, exp_exp_similarity=None, sweepfile=None, nbins=20, phys=True, plot_params='pred', range_x=None, range_y=None, vminmax=3):
+def similarity_heatmap(similarity_file, param_x=0, param_y=1, exp_exp_similarity=None, sweepfile=None, nbins=20, phys=True, plot_params='pred', range_x=None, range_y=None, vminmax=3, server=None):
     """
     Compute heatmaps of similarity between actual/predicted traces.
     if exp_exp_similarity is specified, we normalize to its mean/stdev
     if phys=False, plot w/ unit-normalized params on axes
     sweepfile: if passing an experimental similarity file, pass in the sweep file so it can get traces
+    server: simulate traces on a running sim_server.py (see Similarity)
     """
     with h5py.File(similarity_file, 'r') as infile:
         modelname = infile['similarity'].attrs['modelname']
-        sim = Similarity(modelname, 'stims/chirp23a.csv')
+        sim = Similarity(modelname, 'stims/chirp23a.csv', server=server)
         param_ranges = MODELS_BY_NAME[modelname].PARAM_RANGES
         param_names = MODELS_BY_NAME[modelname].PARAM_NAMES
         nsamples = infile['similarity'].shape[0]
@@ -158,14 +159,14 @@ def similarity_heatmap(similarity_file, param_x=0, param_y=1, exp_exp_similarity
         # Grab 3 true traces
         if is_sim:
             true_params = infile[truth_paramskey][trace_i, :]
-            true_vs = [sim._data_for(*true_p, unit=not phys) for true_p in true_params]
+            true_vs = sim._data_for_many(true_params, unit=not phys)
         else:
             true_params = None
             true_vs = infile['sweep2D'][trace_i, :]
 
         # Grab 3 random sets of predicted params and compute traces for them
         pred_params = infile[pred_paramskey][trace_i, :]
-        pred_vs = [sim._data_for(*pred_p, unit=not phys) for pred_p in pred_params]
+        pred_vs = sim._data_for_many(pred_params, unit=not phys)
 
         # Grab coordinates for circles
         if plot_params == 'truth':